@@ -23,11 +23,257 @@ __author__ = 'Jose Miguel de la Rosa Trevin, Grigory Sharov'
 
 
 import re
+import io
 import os
+import gc
 import sys
+import gzip
+import bz2
+import lzma
+import glob
+import time
 import argparse
 import shlex
-from collections import OrderedDict, namedtuple
+import stat
+import heapq
+import bisect
+import itertools
+import tempfile
+import asyncio
+import functools
+import contextlib
+import importlib
+import pickle
+import threading
+from array import array
+from operator import index as _asIndex, itemgetter
+from io import StringIO
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError:
+    shared_memory = None
+
+try:
+    from isal import igzip_threaded
+except ImportError:
+    igzip_threaded = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# Number of rows parsed at once when reading full tables
+_CHUNK_SIZE = 10000
+# Maximum number of Row classes (one for each set of columns) in the cache
+_ROW_CLASSES_CACHE_SIZE = 1024
+# Minimum number of seconds between two calls to a progress callback
+_PROGRESS_INTERVAL = 0.2
+# Number of rows used to guess the type of the columns
+_GUESS_ROWS = 100
+
+
+class ParseError(Exception):
+    """ Error found when parsing the values of a line of a star file.
+    Attributes:
+        fileName: name of the file, if known.
+        lineNo: number of the line in the file (starting at 1).
+        offset: position of the line in the file, if it can be known.
+        values: the values of the line.
+    """
+    def __init__(self, message, fileName=None, lineNo=None, offset=None,
+                 values=None):
+        Exception.__init__(self, message)
+        self.fileName = fileName
+        self.lineNo = lineNo
+        self.offset = offset
+        self.values = values
+
+
+class Cancelled(Exception):
+    """ Raised when an operation is stopped through its CancelToken. """
+    pass
+
+
+class CancelToken:
+    """ Allow to cancel a long operation (e.g. reading, writing or merging
+    big tables) from another thread. The operation checks the token
+    regularly (after each chunk of rows) and raises Cancelled if
+    cancel() was called.
+    """
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self):
+        """ Request the cancellation of the operations using this token. """
+        self._event.set()
+
+    def isCancelled(self):
+        return self._event.is_set()
+
+    def check(self):
+        """ Raise Cancelled if the cancellation was requested. """
+        if self._event.is_set():
+            raise Cancelled("Operation cancelled.")
+
+
+class _Monitor:
+    """ Track the progress of an operation, calling the progress callback
+    at most once every _PROGRESS_INTERVAL seconds, and check its
+    CancelToken each time that it is updated.
+    """
+    def __init__(self, progress=None, cancel=None, totalBytes=None,
+                 totalRows=None):
+        self.rows = 0
+        self.bytes = 0
+        self.cancel = cancel
+        self._progress = progress
+        self._totalBytes = totalBytes
+        self._totalRows = totalRows
+        self._next = time.monotonic() + _PROGRESS_INTERVAL
+        self._last = None  # Last values passed to the callback
+        if cancel is not None:
+            cancel.check()
+
+    def update(self, rows, bytes):
+        """ Add the rows and bytes that were processed since the last update.
+        """
+        if self.cancel is not None:
+            self.cancel.check()
+
+        self.rows += rows
+        self.bytes += bytes
+
+        if self._progress is not None:
+            now = time.monotonic()
+            if now >= self._next:
+                self._next = now + _PROGRESS_INTERVAL
+                self._notify(self.getFraction())
+
+    def done(self):
+        """ Notify that the operation is complete (only once). """
+        if self._progress is not None:
+            self._notify(1.0)
+
+    def _notify(self, fraction):
+        values = (self.rows, self.bytes, fraction)
+        if values != self._last:
+            self._last = values
+            self._progress(*values)
+
+    def getFraction(self):
+        """ Fraction of the operation completed, or None if unknown. """
+        if self._totalBytes:
+            return min(1.0, self.bytes / self._totalBytes)
+        if self._totalRows:
+            return min(1.0, self.rows / self._totalRows)
+        return None
+
+
+class Stats:
+    """ Counters and timings collected while reading or writing star files.
+
+    A Stats object can be given as the 'stats' argument of Table.read,
+    Table.readStar, Table.iterRows, Table.iterChunks and Table.write (or
+    the Reader) and it is updated as the data is processed. The same
+    object can be used for many files to accumulate the values.
+    Nothing is measured when no stats are given.
+
+    Attributes:
+        bytes: size of the data lines read or written (in characters,
+            which is the same as bytes for ASCII files).
+        lines: number of lines read or written.
+        rows: number of rows read or written.
+        shlexLines: number of lines that were split with shlex because
+            they contain quoted values (much slower than plain split).
+        errors: number of lines that could not be parsed.
+        promotions: number of columns whose guessed type was promoted
+            (int -> float -> str) because of the values of later rows.
+        times: seconds spent in each phase:
+            read: reading the lines from the file (including decompression).
+            split: splitting the lines into string values.
+            convert: converting the values to the columns types.
+            rows: creating the Row objects.
+            format: formatting the rows values when writing.
+            write: writing the lines to the file.
+    """
+    PHASES = ('read', 'split', 'convert', 'rows', 'format', 'write')
+
+    def __init__(self):
+        self.bytes = 0
+        self.lines = 0
+        self.rows = 0
+        self.shlexLines = 0
+        self.errors = 0
+        self.promotions = 0
+        self.times = OrderedDict((p, 0.0) for p in self.PHASES)
+
+    def getTime(self):
+        """ Total seconds spent in all phases. """
+        return sum(self.times.values())
+
+    def toDict(self):
+        """ Return the values as a flat dict, for example to be sent
+        to a monitoring system.
+        """
+        d = OrderedDict([('bytes', self.bytes), ('lines', self.lines),
+                         ('rows', self.rows), ('shlexLines', self.shlexLines),
+                         ('errors', self.errors),
+                         ('promotions', self.promotions),
+                         ('time', self.getTime())])
+        d.update(('%sTime' % p, t) for p, t in self.times.items())
+        return d
+
+    def __str__(self):
+        t = max(self.getTime(), 1e-9)
+        return ("%d rows, %d lines, %d bytes in %0.3f s (%d rows/s). %s"
+                % (self.rows, self.lines, self.bytes, t, self.rows / t,
+                   ', '.join('%s: %0.3f s' % i for i in self.times.items())))
+
+
+class ImageLocation(namedtuple('ImageLocation', ['path', 'index', 'width'])):
+    """ Value of an image location column, e.g. rlnImageName, with the
+    format index@path, as in '000100@Extract/job012/Movies/mic001.mrcs'.
+
+    Use it as the type of the column to parse the values only once, when
+    reading, e.g. Table(fileName=..., types={'rlnImageName': ImageLocation}).
+    Then the index (slice in the stack, starting at 1) and the path of the
+    stack are available without any string processing, and the equal paths
+    read from a file are the same str object. The width of the index is
+    kept to write back the same zero-padded value. The index of locations
+    of single images (without @) is None.
+
+    Locations are sorted by path and then by index.
+    """
+    __slots__ = ()
+
+    def __new__(cls, path, index=None, width=0):
+        """ Create a location from its path and index, or from the string
+        value if only the path is given.
+        """
+        if index is None and not width:
+            indexStr, sep, stackPath = str(path).partition('@')
+            if sep:
+                return tuple.__new__(cls, (stackPath, int(indexStr),
+                                           len(indexStr)))
+        return tuple.__new__(cls, (path, index, width))
+
+    def __str__(self):
+        if self.index is None:
+            return self.path
+        return '%0*d@%s' % (self.width, self.index, self.path)
+
+    def __format__(self, formatSpec):
+        return format(str(self), formatSpec)
 
 
 class _Column:
@@ -118,49 +364,168 @@ class _ColumnsList:
         self._createRowClass()
 
     def _createRowClass(self):
+        self.Row = _getRowClass(tuple(self._columns.keys()))
+
+
+@functools.lru_cache(maxsize=_ROW_CLASSES_CACHE_SIZE)
+def _getRowClass(colNames):
+    """ Return the Row class (a namedtuple) for the given column names.
+    Classes are cached, so tables with the same columns share the same
+    Row class and it is not created again for every table.
+    """
+    class Row(namedtuple('_Row', colNames)):
+        __slots__ = ()
+
+        def hasColumn(self, colName):
+            """ Return True if the row has this column. """
+            return hasattr(self, colName)
+
+        def hasAnyColumn(self, colNames):
+            return any(self.hasColumn(c) for c in colNames)
+
+        def hasAllColumns(self, colNames):
+            return all(self.hasColumn(c) for c in colNames)
+
+        def set(self, key, value):
+            return setattr(self, key, value)
+
+        def get(self, key, default=None):
+            return getattr(self, key, default)
+
+        def __reduce__(self):
+            # Row classes are created dynamically, so rows are pickled
+            # with the column names to recreate the class
+            return _unpickleRow, (self._fields, tuple(self))
+
+    return Row
+
+
+@functools.lru_cache(maxsize=_ROW_CLASSES_CACHE_SIZE)
+def _getRowConverter(Row, types):
+    """ Generate a function that converts the string values of a line into
+    a Row with the given column types. The function is compiled once for
+    each set of columns and types, avoiding per-value dispatch.
+    """
+    args = []
+    items = []
+
+    for i, t in enumerate(types):
+        if t is str:  # Values are already strings
+            items.append('values[%d]' % i)
+        else:
+            args.append('_t%d=_t%d' % (i, i))
+            items.append('_t%d(values[%d])' % (i, i))
+
+    code = ("def _convert(values, _new=_new, Row=Row%s):\n"
+            "    return _new(Row, (%s,))\n"
+            % (''.join(', ' + a for a in args), ', '.join(items)))
+    namespace = {'_new': tuple.__new__, 'Row': Row}
+    namespace.update(('_t%d' % i, t) for i, t in enumerate(types))
+    exec(code, namespace)
+
+    return namespace['_convert']
+
 
-        class Row(namedtuple('_Row', self._columns.keys())):
-            __slots__ = ()
+class _InternDict(dict):
+    """ Map each value to the first equal value that was added, so
+    repeated strings can share the same object.
+    """
+    def __missing__(self, key):
+        self[key] = key
+        return key
 
-            def hasColumn(self, colName):
-                """ Return True if the row has this column. """
-                return hasattr(self, colName)
 
-            def hasAnyColumn(self, colNames):
-                return any(self.hasColumn(c) for c in colNames)
+class _CodesDict(dict):
+    """ Map each value to a consecutive integer code, assigned the first
+    time that the value is found.
+    """
+    def __missing__(self, key):
+        self[key] = code = len(self)
+        return code
 
-            def hasAllColumns(self, colNames):
-                return all(self.hasColumn(c) for c in colNames)
 
-            def set(self, key, value):
-                return setattr(self, key, value)
+def _imageLocationParser():
+    """ Return a function to create ImageLocation values from strings,
+    sharing the equal paths.
+    """
+    paths = _InternDict()
+    new = tuple.__new__
 
-            def get(self, key, default=None):
-                return getattr(self, key, default)
+    def _parse(value):
+        indexStr, sep, path = value.partition('@')
+        if sep:
+            return new(ImageLocation, (paths[path], int(indexStr),
+                                       len(indexStr)))
+        return new(ImageLocation, (paths[indexStr], None, 0))
 
-        self.Row = Row
+    return _parse
 
 
 class _Reader(_ColumnsList):
     """ Internal class to handling reading table data. """
 
-    def __init__(self, inputFile, tableName='', guessType=True, types=None):
+    def __init__(self, inputFile, tableName='', guessType=True, types=None,
+                 errors='raise', stats=None, progress=None, cancel=None,
+                 intern=None, guessRows=_GUESS_ROWS):
         """ Create a new Reader given a filename or file as input.
         Args:
             inputFile: can be either a string (filename) or file object.
             tableName: name of the data that will be read.
-            guessType: if True, the columns type is guessed from the first row.
+            guessType: if True, the columns type is guessed from the first
+                rows. If some later value does not fit the guessed type,
+                the column is promoted (int -> float -> str) while reading.
+                Columns are only promoted to str if errors are raised,
+                otherwise the lines with wrong numbers are errors.
             types: It can be a dictionary {columnName: columnType} pairs that
                 allows to specify types for certain columns.
+            errors: what to do with lines that can not be parsed: 'raise' a
+                ParseError, 'skip' the line or 'collect' the errors (that
+                can be retrieved with getErrors) and skip the lines. A list
+                can also be given to collect the errors into it.
+            stats: optional Stats object to be updated while reading.
+            progress: optional callback function(rows, bytes, fraction)
+                called regularly while reading the rows. The fraction of
+                the file that was read is None if it is unknown (e.g. for
+                compressed files).
+            cancel: optional CancelToken to stop reading, Cancelled is
+                raised when the token is cancelled.
+            intern: True to intern the values of all str columns, or a list
+                with the names of the columns to intern. Equal values of
+                these columns are then the same str object, saving a lot
+                of memory when they repeat (e.g. micrograph names).
+            guessRows: number of rows (from the first one) used to guess
+                the type of the columns.
         """
         _ColumnsList.__init__(self)
         self._shlex = False
+        # Lines read ahead to guess the types, returned by _readline
+        self._pending = deque()
+        self._pendingOffset = None
+        self._readline = None
+        self._dataStart = None
+        self._stats = stats
+        self._monitor = None
+        t0 = None if stats is None else time.perf_counter()
+        # Number of lines read from the input file
+        self._lineNo = 0
+
+        if isinstance(errors, list):
+            self._errors, errors = errors, 'collect'
+        else:
+            self._errors = []
+        if errors not in ('raise', 'skip', 'collect'):
+            raise Exception("Invalid errors value: %s" % errors)
+        self._errorsPolicy = errors
 
         if isinstance(inputFile, str):
-            self._file = open(inputFile)
+            self._file = _openFile(inputFile)
         else:
             self._file = inputFile
 
+        if progress is not None or cancel is not None:
+            self._monitor = _Monitor(progress, cancel,
+                                     totalBytes=_getFileSize(self._file))
+
         dataStr = 'data_%s' % (tableName or '')
         self._findDataLine(self._file, dataStr)
 
@@ -175,7 +540,10 @@ class _Reader(_ColumnsList):
             colNames.append(parts[0][1:])
             if not foundLoop:
                 values.append(parts[1])
+            # Position of the first data line, to parse the rows again
+            self._dataStart = self._tell()
             line = self._file.readline().strip()
+            self._lineNo += 1
 
         self._singleRow = not foundLoop
 
@@ -186,24 +554,247 @@ class _Reader(_ColumnsList):
             else:
                 values = []
 
+        allTypes = types
+        if foundLoop and values and guessType and guessRows > 1:
+            sample = [values]
+            self._pendingOffset = self._tell()
+            while len(sample) < guessRows:
+                nextLine = self._file.readline()
+                self._pending.append(nextLine)
+                stripped = nextLine.strip()
+                if not stripped or stripped.startswith('data_'):
+                    break
+                sample.append(_splitLine(stripped))
+            allTypes = _guessTypes(colNames, sample, errors == 'raise')
+            allTypes.update(types or {})
+
+        self._readline = (self.__readPending if self._pending
+                          else self._file.readline)
         self._createColumns(colNames,
-                            values=values, guessType=guessType, types=types)
+                            values=values, guessType=guessType, types=allTypes)
         self._types = [c.getType() for c in self.getColumns()]
+        # Guessed columns that can be promoted to a wider type
+        self._promotable = set()
+        if guessType:
+            self._promotable = {i for i, col in enumerate(self.getColumns())
+                                if col.getName() not in (types or {})
+                                and col.getType() in (int, float)}
+        self._promoted = set()
+        # Functions used to convert the values of each column
+        self._converters = list(self._types)
+
+        for i, col in enumerate(self.getColumns()):
+            colType = col.getType()
+            if colType is ImageLocation:
+                self._converters[i] = _imageLocationParser()
+            elif colType is str and intern and (intern is True or
+                                                col.getName() in intern):
+                self._converters[i] = _InternDict().__getitem__
+
+        self.__setConverter()
 
         if self._singleRow:
             self._row = self.__rowFromValues(values)
+        elif values:
+            self._row = self.__rowFromValues(values, line=line)
+            if self._row is None:  # skipped
+                self._row = self.__nextRow()
         else:
-            self._row = self.__rowFromValues(values) if values else None
+            self._row = None
 
-    def __rowFromValues(self, values):
+        # Pair (row, values) with the values of a row read ahead, to
+        # convert it again when the types are promoted
+        self._rowValues = (self._row, values)
+
+        if stats is not None:
+            stats.lines += self._lineNo
+            if foundLoop and values:
+                stats.bytes += len(line) + 1
+            stats.times['read'] += time.perf_counter() - t0
+
+    def __setConverter(self):
+        """ Create the function that converts the values into a Row. """
+        if self._converters != self._types:
+            # Do not cache a converter that is only valid for this reader
+            self._convert = _getRowConverter.__wrapped__(
+                self.Row, tuple(self._converters))
+        else:
+            self._convert = _getRowConverter(self.Row, tuple(self._types))
 
+    def __promoteColumns(self, rows):
+        """ Promote the type of the guessed columns whose values in these
+        rows (lists of strings) do not fit it: int -> float -> str.
+        Returns:
+            True if the type of any column was changed.
+        """
+        n = len(self._types)
+        rows = [values for values in rows if len(values) == n]
+        columns = list(self.getColumns())
+        promoted = False
+
+        # Wrong values are only kept as str when errors are raised,
+        # otherwise their lines are skipped (or collected) as errors
+        allowStr = self._errorsPolicy == 'raise'
+
+        for i in sorted(self._promotable):
+            colType = self._types[i]
+            newType = _guessColumnType([values[i] for values in rows],
+                                       colType, allowStr)
+            if newType is not colType:
+                self._types[i] = self._converters[i] = newType
+                columns[i].setType(newType)
+                self._promoted.add(i)
+                promoted = True
+                if newType is str:
+                    self._promotable.discard(i)
+                if self._stats is not None:
+                    self._stats.promotions += 1
+
+        if promoted:
+            self.__setConverter()
+        return promoted
+
+    def _widenTypes(self, types):
+        """ Promote the guessed columns to the types of a dict
+        {columnName: columnType} that are wider (int -> float -> str),
+        e.g. to read many files with the same types. It should be called
+        before reading any row.
+        """
+        columns = list(self.getColumns())
+        promoted = False
+
+        for i in sorted(self._promotable):
+            colType = self._types[i]
+            newType = types.get(columns[i].getName(), colType)
+            if _PROMOTIONS.index(newType) > _PROMOTIONS.index(colType):
+                self._types[i] = self._converters[i] = newType
+                columns[i].setType(newType)
+                promoted = True
+                if newType is str:
+                    self._promotable.discard(i)
+
+        if promoted:
+            self.__setConverter()
+            self.__convertNextRow()
+
+    def __convertNextRow(self):
+        """ Convert again the next row with the current types, if its
+        values are known.
+        """
+        row, values = self._rowValues
+        if self._row is not None and row is self._row:
+            self._row = self._convert(values)
+            self._rowValues = (self._row, values)
+
+    def _reparse(self):
+        """ Parse again all the rows of the table with the current types
+        of the columns, e.g. to get the original text of the values of
+        columns promoted to str. The lines that could not be parsed were
+        already handled in the first read, so they are just skipped now.
+        Returns:
+            The list of rows, or None if the file can not be read again.
+        """
+        if self._dataStart is None or self._singleRow:
+            return None
+        try:
+            self._file.seek(self._dataStart)
+        except Exception:
+            return None
+
+        rows = []
+        convert = self._convert
+        for line in iter(self._file.readline, ''):
+            stripped = line.strip()
+            if not stripped or stripped.startswith('data_'):
+                break
+            try:
+                rows.append(convert(self._split(line)))
+            except Exception:
+                pass
+        return rows
+
+    def __readPending(self):
+        """ Return the lines read ahead to guess the types, and then
+        continue reading from the file.
+        """
+        if self._pending:
+            line = self._pending.popleft()
+            if self._pendingOffset is not None:
+                self._pendingOffset += len(line.encode())
+            return line
+        self._readline = self._file.readline
+        return self._readline()
+
+    def __rowFromValues(self, values, lineNo=None, offset=None, line=None):
+        """ Convert the values into a Row. If there is an error and it is not
+        raised, None is returned. If lineNo is None, the values are from the
+        last line read (line), otherwise the offset of the line is given.
+        """
         try:
-            return self.Row(*[t(v) for t, v in zip(self._types, values)])
+            return self._convert(values)
         except Exception as e:
-            print("Error when parsing column types:")
-            for i in zip(self._columns.keys(), self._types, values):
-                print(i)
-            raise e
+            if self._promotable and self.__promoteColumns([values]):
+                return self.__rowFromValues(values, lineNo, offset, line)
+            if lineNo is None:
+                lineNo = self._lineNo
+                offset = self._tell()
+                if offset is not None and line is not None:
+                    offset -= len(line.encode())
+            error = self._createError(values, lineNo, offset, e)
+            if self._stats is not None:
+                self._stats.errors += 1
+            if self._errorsPolicy == 'raise':
+                raise error from e
+            elif self._errorsPolicy == 'collect':
+                self._errors.append(error)
+            return None
+
+    def __nextRow(self):
+        """ Read lines until a valid row is found, or None at the end. """
+        readline = self._readline
+
+        while True:
+            line = readline()
+            self._lineNo += 1
+            stripped = line.strip()
+            if not stripped or stripped.startswith('data_'):
+                return None
+            row = self.__rowFromValues(self._split(line), line=line)
+            if row is not None:
+                return row
+
+    def _tell(self):
+        """ Current position of the file or None if it is not available. """
+        if self._pending:  # Position of the next line read ahead
+            return self._pendingOffset
+        try:
+            return self._file.tell()
+        except Exception:
+            return None
+
+    def _createError(self, values, lineNo, offset, error):
+        """ Create a ParseError describing the error with these values. """
+        fileName = getattr(self._file, 'name', None)
+        fileName = fileName if isinstance(fileName, str) else None
+        msg = "Error parsing line %d" % lineNo
+        if fileName:
+            msg += " of file '%s'" % fileName
+        msg += ": %s: %s\n" % (type(error).__name__, error)
+
+        if len(values) != len(self._types):
+            msg += ("  expected %d values, but found %d\n"
+                    % (len(self._types), len(values)))
+
+        for col, t, v in zip(self.getColumnNames(), self._types, values):
+            msg += "  %s (%s): %r\n" % (col, getattr(t, '__name__', t), v)
+
+        return ParseError(msg, fileName, lineNo, offset, values)
+
+    def getErrors(self):
+        """ Return the list of ParseError of the lines that were skipped,
+        only when errors are collected.
+        """
+        return self._errors
 
     def getRow(self):
         """ Get the next Row, it is None when not more rows. """
@@ -212,9 +803,7 @@ class _Reader(_ColumnsList):
         if self._singleRow:
             self._row = None
         elif result is not None:
-            line = self._file.readline().strip()
-            line = None if line.startswith("data_") else line
-            self._row = self.__rowFromValues(self._split(line)) if line else None
+            self._row = self.__nextRow()
 
         return result
 
@@ -223,10 +812,12 @@ class _Reader(_ColumnsList):
         Move the line pointer after the desired line if found.
         """
         line = inputFile.readline()
+        self._lineNo += 1
         while line:
             if line.startswith(dataStr):
                 return line
             line = inputFile.readline()
+            self._lineNo += 1
 
         raise Exception("'%s' block was not found" % dataStr)
 
@@ -235,6 +826,7 @@ class _Reader(_ColumnsList):
         foundLoop = False
 
         rawLine = inputFile.readline()
+        self._lineNo += 1
         while rawLine:
             line = rawLine.strip()
             if line.startswith('_'):
@@ -242,6 +834,7 @@ class _Reader(_ColumnsList):
             elif line.startswith('loop_'):
                 foundLoop = True
             rawLine = inputFile.readline()
+            self._lineNo += 1
 
         return line, foundLoop
 
@@ -255,14 +848,198 @@ class _Reader(_ColumnsList):
         def _shlex(line):
             return shlex.split(line)
 
-        self._split = _shlex if bool(re.search(r'\'|\"+', line)) else _split
+        self._shlex = bool(re.search(r'\'|\"+', line))
+        self._split = _shlex if self._shlex else _split
+
+
+    def readChunk(self, chunkSize):
+        """ Read up to chunkSize rows and return them grouped by columns.
+        Lines are split and converted in bulk, so the per-row overhead of
+        getRow is avoided.
+        Returns:
+            A list with the values of each column (same order of the
+            columns) or None if there are no more rows.
+        """
+        first = self._row
+        monitor = self._monitor
+        if first is None:
+            if monitor is not None:
+                monitor.done()
+            return None
+
+        row, firstValues = self._rowValues
+        types = list(self._types)
+        self._row = None
+        lines = []
+        firstLineNo = self._lineNo + 1
+        offset = None if self._errorsPolicy == 'skip' else self._tell()
+        stats = self._stats
+        nextBytes = 0  # Size of the line of the next row
+        if stats is not None:
+            t0 = time.perf_counter()
+
+        if not self._singleRow:
+            readline = self._readline
+            for i in range(chunkSize):
+                line = readline()
+                stripped = line.strip()
+                if not stripped or stripped.startswith('data_'):
+                    self._lineNo += i + 1
+                    break
+                lines.append(line)
+            else:
+                # There are more rows, keep the last one as the next row
+                self._lineNo += chunkSize
+                line = lines.pop()
+                nextBytes = len(line)
+                values = self._split(line)
+                self._row = (self.__rowFromValues(values, line=line)
+                             or self.__nextRow())
+                self._rowValues = (self._row, values)
+
+        if stats is not None or monitor is not None:
+            nBytes = sum(map(len, lines)) + nextBytes
+
+        if stats is not None:
+            stats.times['read'] += time.perf_counter() - t0
+            stats.lines += self._lineNo - firstLineNo + 1
+            stats.bytes += nBytes
+            if self._shlex:
+                stats.shlexLines += len(lines)
+
+        columns = (self.__columnsFromLines(lines, firstLineNo, offset)
+                   if lines else [[] for _ in first])
+
+        if self._types != types:
+            # Rows read ahead were converted before promoting some columns
+            if row is first:
+                first = self._convert(firstValues)
+            self.__convertNextRow()
+        columns = [[v] + c for v, c in zip(first, columns)]
+
+        if stats is not None:
+            stats.rows += len(columns[0]) if columns else 0
+        if monitor is not None:
+            monitor.update(len(columns[0]) if columns else 0, nBytes)
+        return columns
+
+    def __columnsFromLines(self, lines, firstLineNo, offset):
+        """ Split the lines and convert the values column-wise.
+        Args:
+            lines: lines to be parsed.
+            firstLineNo: line number of the first line.
+            offset: position of the first line in the file, if known.
+        """
+        stats = self._stats
+        if stats is not None:
+            t0 = time.perf_counter()
+        rows = list(map(self._split, lines))
+        if stats is not None:
+            t1 = time.perf_counter()
+            stats.times['split'] += t1 - t0
+
+        if set(map(len, rows)) == {len(self._types)}:
+            while True:
+                try:
+                    columns = [list(c) if t is str else list(map(t, c))
+                               for t, c in zip(self._converters, zip(*rows))]
+                    if stats is not None:
+                        stats.times['convert'] += time.perf_counter() - t1
+                    return columns
+                except Exception:
+                    # Retry if some guessed column type can be promoted,
+                    # otherwise parse row by row below to find the errors
+                    if not (self._promotable and self.__promoteColumns(rows)):
+                        break
+
+        result = []
+        for i, values in enumerate(rows):
+            try:
+                result.append(self._convert(values))
+            except Exception:
+                lineOffset = None
+                if offset is not None:
+                    lineOffset = offset + sum(len(l.encode())
+                                              for l in lines[:i])
+                # Promote the columns, or raise or register the error
+                row = self.__rowFromValues(values, firstLineNo + i,
+                                           lineOffset)
+                if row is not None:
+                    result.append(row)
+
+        if stats is not None:
+            stats.times['convert'] += time.perf_counter() - t1
+
+        if not result:
+            return [[] for _ in self._types]
+
+        return [list(c) for c in zip(*result)]
+
+    def iterValues(self):
+        """ Iterate over the remaining rows as plain tuples of values. """
+        columns = self.readChunk(_CHUNK_SIZE)
+
+        while columns is not None:
+            for values in zip(*columns):
+                yield values
+            columns = self.readChunk(_CHUNK_SIZE)
+
+    def readRows(self, numberOfRows):
+        """ Read up to numberOfRows rows and return them as a list,
+        that is empty when there are no more rows.
+        """
+        columns = self.readChunk(numberOfRows)
+        if columns is None:
+            return []
+
+        if self._stats is None:
+            return list(map(self.Row._make, zip(*columns)))
 
+        t0 = time.perf_counter()
+        rows = list(map(self.Row._make, zip(*columns)))
+        self._stats.times['rows'] += time.perf_counter() - t0
+        return rows
 
     def readAll(self):
         """ Read all rows and return as a list. """
-        return list(iter(self))
+        rows = []
+
+        with _bulkAllocation():
+            chunk = self.readRows(_CHUNK_SIZE)
+            while chunk:
+                rows.extend(chunk)
+                chunk = self.readRows(_CHUNK_SIZE)
+
+            if self._promoted and rows:
+                rows = self.__fixPromotedRows(rows)
+
+        return rows
+
+    def __fixPromotedRows(self, rows):
+        """ Convert the values of the rows read before the promotion of
+        some columns. If any column was promoted to str, the rows are
+        parsed again to keep the original text of the values, or the
+        numbers are converted to str if the file can not be read again.
+        """
+        if any(self._types[i] is str for i in self._promoted):
+            reparsed = self._reparse()
+            if reparsed is not None:
+                return reparsed
+
+        columns = list(zip(*rows))
+        for i in self._promoted:
+            columns[i] = map(self._types[i], columns[i])
+        return list(map(self.Row._make, zip(*columns)))
 
     def __iter__(self):
+        if self._stats is not None or self._monitor is not None:
+            # Read by chunks to measure and check each chunk, not every row
+            rows = self.readRows(_CHUNK_SIZE)
+            while rows:
+                yield from rows
+                rows = self.readRows(_CHUNK_SIZE)
+            return
+
         row = self.getRow()
 
         while row is not None:
@@ -272,10 +1049,13 @@ class _Reader(_ColumnsList):
 
 class _Writer:
     """ Write star tables to file. """
-    def __init__(self, inputFile):
+    def __init__(self, inputFile, stats=None, progress=None, cancel=None):
         self._file = inputFile
         self._format = None
         self._columns = None
+        self._stats = stats
+        self._progress = progress
+        self._cancel = cancel
 
     def writeTableName(self, tableName):
         self._file.write("\ndata_%s\n\n" % (tableName or ''))
@@ -308,6 +1088,37 @@ class _Writer:
         """
         self.writeRowValues(row._asdict().values())
 
+    def writeRows(self, rows):
+        """ Write the lines of all these rows. """
+        if self._stats is None and self._progress is None \
+                and self._cancel is None:
+            for row in rows:
+                self.writeRow(row)
+            return
+
+        # Format and write by chunks to measure and check each chunk
+        stats = self._stats
+        monitor = _Monitor(self._progress, self._cancel, totalRows=len(rows))
+        if not self._format and rows:
+            self._computeLineFormat([rows[0]])
+
+        for i in range(0, len(rows), _CHUNK_SIZE):
+            t0 = time.perf_counter()
+            data = ''.join([self._format.format(*r)
+                            for r in rows[i:i + _CHUNK_SIZE]])
+            t1 = time.perf_counter()
+            self._file.write(data)
+            n = min(_CHUNK_SIZE, len(rows) - i)
+            if stats is not None:
+                stats.times['format'] += t1 - t0
+                stats.times['write'] += time.perf_counter() - t1
+                stats.rows += n
+                stats.lines += n
+                stats.bytes += len(data)
+            monitor.update(n, len(data))
+
+        monitor.done()
+
     def writeNewline(self):
         self._file.write('\n')
 
@@ -330,6 +1141,88 @@ class _Writer:
                                 for w, f in zip(widths, formats)) + '\n'
 
 
+class _SplitWriter:
+    """ Route rows to many output star files with the same columns.
+    Rows are written to in-memory buffers that are appended to the files
+    once they are big enough, so no file is kept open for each output.
+    """
+    def __init__(self, header, tableName, columns, bufferRows=_CHUNK_SIZE):
+        self._header = header
+        self._tableName = tableName
+        self._columns = columns
+        self._bufferRows = bufferRows
+        # {key: [fileName, writer, bufferedRows]}
+        self._outputs = OrderedDict()
+
+    def writeRowValues(self, key, fileName, values):
+        """ Write the row values to the output for this key.
+        The fileName is only used the first time the key is found.
+        """
+        output = self._outputs.get(key, None)
+
+        if output is None:
+            if os.path.exists(fileName):
+                os.remove(fileName)
+            writer = _Writer(StringIO())
+            writer._file.write(self._header)
+            writer.writeTableName(self._tableName)
+            writer.writeHeader(self._columns)
+            output = self._outputs[key] = [fileName, writer, 0]
+
+        output[1].writeRowValues(values)
+        output[2] += 1
+
+        if output[2] == self._bufferRows:
+            self._flush(output)
+
+    def _flush(self, output):
+        fileName, writer, _ = output
+        with _openFile(fileName, 'a') as f:
+            f.write(writer._file.getvalue())
+        writer._file.seek(0)
+        writer._file.truncate()
+        output[2] = 0
+
+    def close(self):
+        """ Flush all buffers and return the {key: fileName} pairs. """
+        for output in self._outputs.values():
+            output[1].writeNewline()
+            self._flush(output)
+
+        return OrderedDict((k, o[0]) for k, o in self._outputs.items())
+
+
+class _TableInfo(_ColumnsList):
+    """ Lightweight description of a table in a star file, as returned
+    by Table.probe. It contains the columns (with guessed types) and the
+    number of rows, but no rows and no Row class.
+    """
+    def __init__(self, tableName, columns, size, singleRow=False):
+        _ColumnsList.__init__(self)
+        self._name = tableName
+        self._size = size
+        self._singleRow = singleRow
+        for col in columns:
+            self._columns[col.getName()] = col
+
+    def __str__(self):
+        return 'Table: data_%s (columns: %d, rows: %d)' % (
+            self._name, len(self._columns), self._size)
+
+    def getName(self):
+        return self._name
+
+    def isSingleRow(self):
+        """ Return True if the table is written as label-value pairs. """
+        return self._singleRow
+
+    def size(self):
+        return self._size
+
+    def __len__(self):
+        return self.size()
+
+
 class Table(_ColumnsList):
     """
     Class to hold and manipulate tabular data for EM processing programs.
@@ -340,6 +1233,10 @@ class Table(_ColumnsList):
 
     def __init__(self, **kwargs):
         _ColumnsList.__init__(self)
+        self._frozen = False
+        self._rows = []
+        # Rows (list) shared with some views, that should not be modified
+        self._sharedRows = None
         self.clear()
 
         if 'fileName' in kwargs:
@@ -353,50 +1250,182 @@ class Table(_ColumnsList):
             self._createColumns(kwargs['columns'])
 
     def clear(self):
+        self._checkMutable(replaceRows=True)
         self.Row = None
         self._columns.clear()
         self._rows = []
+        self._errors = []
         self._inputFile = None
         self._inputLine = None
 
     def clearRows(self):
         """ Remove all the rows from the table, but keep its columns. """
+        self._checkMutable(replaceRows=True)
         self._rows = []
 
     def addRow(self, *args, **kwargs):
+        self._checkMutable()
         self._rows.append(self.Row(*args, **kwargs))
 
-    def readStar(self, inputFile, tableName=None, guessType=True, types=None):
+    def extend(self, rows):
+        """ Add many rows at once.
+        Args:
+            rows: iterable of tuples (or rows of a table with the same
+                columns) with the values in the order of the columns.
+                It can also be a 2D NumPy array.
+        """
+        self._checkMutable()
+        if np is not None and isinstance(rows, np.ndarray):
+            rows = rows.tolist()
+        with _bulkAllocation():
+            self._rows.extend(map(self.Row._make, rows))
+
+    def freeze(self):
+        """ Return an immutable snapshot of this table.
+
+        The frozen table shares the rows with this one (rows are immutable
+        namedtuples), so no data is copied, but any method that modifies
+        it will raise an exception. Since it never changes, a frozen table
+        can be safely read from many threads at the same time.
+        """
+        if self._frozen:
+            return self
+
+        table = Table(columns=[_Column(c.getName(), c.getType())
+                               for c in self.getColumns()])
+        table.Row = self.Row
+        # Views and columnar rows are also read-only, they are not copied
+        table._rows = (self._rows if isinstance(self._rows, (_RowsView,
+                                                             _ColumnarRows))
+                       else tuple(self._rows))
+        table._frozen = True
+        return table
+
+    def isFrozen(self):
+        """ Return True if the table can not be modified, because it is
+        frozen or its values are stored by columns (see readStar).
+        """
+        return self._frozen or isinstance(self._rows, _ColumnarRows)
+
+    def share(self):
+        """ Copy the table data into a block of shared memory.
+
+        Returns:
+            A SharedTable that can be sent to other processes at the cost of
+            pickling only the columns and the name of the memory block.
+            The processes can then rebuild a frozen copy of the table
+            with its getTable method. The process that shares the table is
+            responsible for calling unlink() when it is not longer needed.
+        """
+        if shared_memory is None:
+            raise Exception("Shared memory requires Python 3.8 or newer.")
+
+        columns = [_Column(c.getName(), c.getType()) for c in self.getColumns()]
+        buffers = _packColumns(columns, self._rows)
+        size = max(1, sum(len(data) for _, data in buffers))
+        shm = shared_memory.SharedMemory(create=True, size=size)
+        layout = []
+        offset = 0
+
+        for code, data in buffers:
+            shm.buf[offset:offset + len(data)] = data
+            layout.append((code, offset, len(data)))
+            offset += len(data)
+
+        return SharedTable(columns, layout, len(self._rows), shm)
+
+    def readStar(self, inputFile, tableName=None, guessType=True, types=None,
+                 errors='raise', stats=None, progress=None, cancel=None,
+                 intern=None, precision=None, dtypes=None,
+                 guessRows=_GUESS_ROWS):
         """ Parse a given table from the input star file.
         Args:
             inputFile: Provide the input file from where to read the data.
                 The file pointer will be moved until the last data line of the
                 requested table.
             tableName: star table name
-            guessType: if True, the columns type is guessed from the first row.
+            guessType: if True, the columns type is guessed from the first
+                rows (see guessRows). Columns with later values that do not
+                fit the guessed type are promoted: int -> float -> str
+                (to str only when errors are raised, see the Reader).
             types: It can be a dictionary {columnName: columnType} pairs that
                 allows to specify types for certain columns.
+            errors: what to do with lines that can not be parsed: 'raise' a
+                ParseError, 'skip' the line or 'collect' the errors (that
+                can be retrieved later with getErrors) and skip the lines.
+            stats: optional Stats object to be updated while reading.
+            progress: optional callback function(rows, bytes, fraction)
+                called regularly while reading. The fraction of the
+                file that was read is None when it is unknown.
+            cancel: optional CancelToken to stop reading. If the token is
+                cancelled, Cancelled is raised and the table is left empty.
+            intern: True to intern the values of all str columns, or a list
+                with the names of the columns to intern, so repeated values
+                are stored only once in memory.
+            precision: if 'compact', the values of float columns are stored
+                as float32 and the ones of int columns with the smallest
+                integer type that fits them (from int8 to int64).
+            dtypes: dictionary {columnName: dtype} with the storage type
+                of some numeric columns: 'float32', 'float64', 'int8',
+                'int16', 'int32' or 'int64'.
+                If precision or dtypes are given, the values are stored by
+                columns, using much less memory, and the rows are created
+                when they are accessed. These tables can not be modified,
+                but they can be read again. The values written are the
+                same, within the precision of the types.
+            guessRows: number of rows used to guess the type of the columns.
         """
         self.clear()
         reader = _Reader(inputFile, tableName=tableName, guessType=guessType,
-                         types=types)
+                         types=types, errors=errors, stats=stats,
+                         progress=progress, cancel=cancel, intern=intern,
+                         guessRows=guessRows)
+        if precision is None and dtypes is None:
+            rows = reader.readAll()
+        else:
+            rows = _readColumnar(reader, precision, dtypes or {})
         self._columns = reader._columns
-        self._rows = reader.readAll()
+        self._rows = rows
+        self._errors = reader.getErrors()
         self.Row = reader.Row
 
+    def getErrors(self):
+        """ Return the list of ParseError of the lines skipped in the last
+        read, when it was called with errors='collect'.
+        """
+        return self._errors
+
     def read(self, fileName, tableName=None, **kwargs):
-        with open(fileName) as f:
+        with _openFile(fileName) as f:
             self.readStar(f, tableName, **kwargs)
 
-    def writeStar(self, outputFile, tableName=None, singleRow=False):
+    async def aread(self, fileName, tableName=None, executor=None, **kwargs):
+        """ Asynchronous version of read. The file is read and parsed in
+        the given executor (or the default thread pool of the event loop).
+        Returns:
+            This same table, already filled with the rows.
+        """
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(executor, functools.partial(
+            self.read, fileName, tableName, **kwargs))
+        return self
+
+    def writeStar(self, outputFile, tableName=None, singleRow=False,
+                  stats=None, progress=None, cancel=None):
         """ Write a Table in Star format to the given file.
         Args:
             outputFile: File handler that should be already opened and
                 in the position to write.
             tableName: The name of the table to write.
             singleRow: If True, don't write loop_, just label - value pairs.
+            stats: optional Stats object to be updated while writing.
+            progress: optional callback function(rows, bytes, fraction)
+                called regularly while writing the rows.
+            cancel: optional CancelToken to stop writing, Cancelled is
+                raised when the token is cancelled.
         """
-        writer = _Writer(outputFile)
+        writer = _Writer(outputFile, stats=stats, progress=progress,
+                         cancel=cancel)
         writer.writeTableName(tableName)
 
         if self.size() == 0:
@@ -406,16 +1435,32 @@ class Table(_ColumnsList):
             writer.writeSingleRow(self._rows[0])
         else:
             writer.writeHeader(self._columns.values())
-            for row in self:
-                writer.writeRow(row)
+            writer.writeRows(self._rows)
 
         writer.writeNewline()
 
-    def write(self, output_star, tableName=None, singleRow=False):
-        with open(output_star, 'w') as output_file:
+    def write(self, output_star, tableName=None, singleRow=False, **kwargs):
+        """ Write the table to the given file name.
+        Args:
+            output_star: output star file name.
+            tableName: The name of the table to write.
+            singleRow: If True, don't write loop_, just label - value pairs.
+            **kwargs: stats, progress or cancel (see writeStar).
+        """
+        with _openFile(output_star, 'w') as output_file:
             self.writeStar(output_file,
                            tableName=tableName,
-                           singleRow=singleRow)
+                           singleRow=singleRow,
+                           **kwargs)
+
+    async def awrite(self, output_star, tableName=None, singleRow=False,
+                     executor=None, **kwargs):
+        """ Asynchronous version of write. The file is formatted and written
+        in the given executor (or the default thread pool of the event loop).
+        """
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(executor, functools.partial(
+            self.write, output_star, tableName, singleRow, **kwargs))
 
     def printStar(self, tableName=None):
         self.writeStar(sys.stdout, tableName)
@@ -433,6 +1478,7 @@ class Table(_ColumnsList):
         Examples:
             table.addColumns('rlnDefocusU=rlnDefocusV', 'rlnDefocusAngle=0.0')
         """
+        self._checkMutable()
         # TODO:
         # Maybe implement more complex value expression,
         # e.g some basic arithmetic operations or functions
@@ -476,6 +1522,7 @@ class Table(_ColumnsList):
 
     def removeColumns(self, *args):
         """ Remove columns with these names. """
+        self._checkMutable()
         # Check if any argument is a list and flatten into a single one
         rmCols = []
         for a in args:
@@ -507,13 +1554,265 @@ class Table(_ColumnsList):
         """
         if colName not in self._columns:
             raise Exception("Non-existing column: %s" % colName)
+        if isinstance(self._rows, (_ColumnarRows, _RowsView)):
+            return self._rows.getColumnValues(list(self._columns).index(colName))
         return [getattr(row, colName) for row in self._rows]
 
-    def sort(self, key, reverse=False):
+    def getColumnArray(self, colName, dtype=None):
+        """ Return the values of a given column as a NumPy array.
+        The array is filled in a single pass over the rows, without
+        building an intermediate list of values.
+        Args:
+            colName: The name of an existing column to retrieve values.
+            dtype: NumPy dtype of the array, by default int64 for int
+                columns, float64 for float columns and object for others.
+        """
+        if np is None:
+            raise Exception("NumPy is required to get columns as arrays.")
+        if colName not in self._columns:
+            raise Exception("Non-existing column: %s" % colName)
+
+        index = list(self._columns).index(colName)
+        colType = self._columns[colName].getType()
+        if isinstance(self._rows, (_ColumnarRows, _RowsView)):
+            return self._rows.getColumnArray(index, colType, dtype)
+        return _columnArray(self._rows, index, colType, dtype)
+
+    def getColumnArrays(self, colNames, dtype=None):
+        """ Return the values of many columns as NumPy arrays.
+        Args:
+            colNames: list with the names of existing columns.
+            dtype: NumPy dtype used for all arrays, or a dict with the dtype
+                of some columns (see getColumnArray for the default dtypes).
+        Returns:
+            An OrderedDict with {columnName: array} pairs.
+        """
+        if not isinstance(dtype, dict):
+            dtype = dict.fromkeys(colNames, dtype)
+        return OrderedDict((colName, self.getColumnArray(colName,
+                                                         dtype.get(colName)))
+                           for colName in colNames)
+
+    def getColumnCodes(self, colName):
+        """ Return the dictionary encoding of a column, that allows to
+        filter or group the rows comparing integers instead of values.
+        Args:
+            colName: The name of an existing column.
+        Returns:
+            A tuple (codes, values), where values is the list of distinct
+            values of the column (in order of appearance) and codes is a
+            NumPy int32 array with the index in values of each row value.
+        """
+        if np is None:
+            raise Exception("NumPy is required to get columns codes.")
+        if colName not in self._columns:
+            raise Exception("Non-existing column: %s" % colName)
+
+        index = list(self._columns).index(colName)
+        codes = _CodesDict()
+        values = map(itemgetter(index), self._rows)
+        codesArray = np.fromiter(map(codes.__getitem__, values),
+                                 dtype=np.int32, count=len(self._rows))
+        return codesArray, list(codes)
+
+    def getAccessPlan(self, colName='rlnImageName'):
+        """ Return an AccessPlan to read the images of the rows grouped by
+        stack file (sorted by path) and by slice index in each stack,
+        instead of jumping across the stacks in the order of the rows.
+        Args:
+            colName: column with the images locations (index@path), the
+                values can be strings or ImageLocation.
+        """
+        if colName not in self._columns:
+            raise Exception("Non-existing column: %s" % colName)
+
+        index = list(self._columns).index(colName)
+        values = list(map(itemgetter(index), self._rows))
+        codes = _CodesDict()
+
+        with _bulkAllocation():
+            if all(type(v) is ImageLocation for v in values):
+                paths = map(itemgetter(0), values)
+                slices = [i or 0 for i in map(itemgetter(1), values)]
+            else:
+                parts = list(map(str.partition, map(str, values),
+                                 itertools.repeat('@')))
+                if all(map(itemgetter(1), parts)):  # all have index
+                    paths = map(itemgetter(2), parts)
+                    slices = list(map(int, map(itemgetter(0), parts)))
+                else:
+                    paths = [p[2] if p[1] else p[0] for p in parts]
+                    slices = [int(p[0]) if p[1] else 0 for p in parts]
+            pathCodes = list(map(codes.__getitem__, paths))
+
+            # Sort by a single integer key, much faster than sorting tuples
+            paths = sorted(codes)
+            ranks = [0] * len(paths)
+            for rank, path in enumerate(paths):
+                ranks[codes[path]] = rank
+            base = max(slices, default=0) + 1
+            keys = [ranks[c] * base + i for c, i in zip(pathCodes, slices)]
+            order = sorted(range(len(keys)), key=keys.__getitem__)
+            keys = list(map(keys.__getitem__, order))
+            slices = list(map(slices.__getitem__, order))
+
+        # Rows of each path are between the keys of the path and the next
+        limits = [bisect.bisect_left(keys, rank * base)
+                  for rank in range(len(paths) + 1)]
+        groups = [(path, start, end) for path, start, end
+                  in zip(paths, limits, limits[1:])]
+
+        return AccessPlan(order, slices, groups)
+
+    def toDataFrame(self):
+        """ Return a pandas DataFrame with the values of this table.
+        The data is moved column by column, int and float columns are
+        stored as int64 and float64 and other columns with object dtype,
+        so the table can be recreated with the same types by fromDataFrame.
+        """
+        pd = _importOptional('pandas')
+        return pd.DataFrame(self.getColumnArrays(self.getColumnNames()),
+                            copy=False)
+
+    def toArrow(self, tableName=None):
+        """ Return a pyarrow Table with the values of this table.
+        Columns of type int and float are stored as int64 and float64
+        and the other ones as strings.
+        Args:
+            tableName: name of the star table (data_ block) that is kept
+                in the schema metadata.
+        """
+        pa = _importOptional('pyarrow')
+        arrays = []
+
+        for col in self.getColumns():
+            colName, colType = col.getName(), col.getType()
+            if colType in _ARROW_TYPES:
+                arrays.append(pa.array(self.getColumnArray(colName),
+                                       type=_ARROW_TYPES[colType]))
+            else:
+                values = list(map(str, self.getColumnValues(colName)))
+                arrays.append(pa.array(values, type=pa.string()))
+
+        metadata = {_ARROW_TABLE_NAME: tableName or ''}
+        return pa.Table.from_arrays(arrays, names=self.getColumnNames(),
+                                    metadata=metadata)
+
+    def writeParquet(self, fileName, tableName=None, compression='zstd'):
+        """ Write the table to a Parquet file (pyarrow is required).
+        Each star table (data_ block) is written to its own file.
+        Args:
+            fileName: output Parquet file name.
+            tableName: name of the star table that is kept in the file.
+            compression: Parquet compression codec.
+        """
+        _importOptional('pyarrow.parquet').write_table(
+            self.toArrow(tableName), fileName, compression=compression)
+
+    def argsort(self, key, reverse=False, cancel=None):
+        """ Return the permutation of the rows that sorts the table,
+        without modifying it. The sort is stable (also in reverse order).
+        Args:
+            key: name of a column, a list of column names (from the main
+                key to the last one) or a function called with each row.
+            reverse: If true reverse the sort order. It can also be a list
+                with a value for each column name in key.
+            cancel: optional CancelToken checked while sorting.
+        Returns:
+            A NumPy array with the index of the rows in sorted order
+            (a list if NumPy is not available).
+        """
+        keys = [key] if isinstance(key, str) or callable(key) else list(key)
+        if isinstance(reverse, (list, tuple)):
+            if len(reverse) != len(keys):
+                raise Exception("Expected %d reverse values, but found %d"
+                                % (len(keys), len(reverse)))
+            reverses = list(reverse)
+        else:
+            reverses = [reverse] * len(keys)
+
+        for k in keys:
+            if isinstance(k, str) and k not in self._columns:
+                raise Exception("Non-existing column: %s" % k)
+
+        if cancel is not None:
+            cancel.check()
+
+        if np is not None and not any(map(callable, keys)):
+            sortKeys = []
+            # Last key first, as expected by lexsort
+            for k, r in zip(reversed(keys), reversed(reverses)):
+                sortKeys.append(self._getSortKey(k, r))
+                if cancel is not None:
+                    cancel.check()
+            if not sortKeys or not len(self._rows):
+                return np.arange(len(self._rows))
+            return np.lexsort(sortKeys)
+
+        # Sort by each key, from the last one, relying on a stable sort
+        order = list(range(len(self._rows)))
+        for k, r in zip(reversed(keys), reversed(reverses)):
+            if callable(k):
+                keyFunc = k
+            else:
+                keyFunc = itemgetter(list(self._columns).index(k))
+            values = list(map(keyFunc, self._rows))
+            getValue = values.__getitem__
+            if cancel is not None:
+                getValue = _cancellable(getValue, cancel)
+            order.sort(key=getValue, reverse=r)
+        return order
+
+    def _hasOnlyType(self, colName, colType):
+        """ Return True if all values of a column are of the given type,
+        as the numbers stored in arrays by compact tables.
+        """
+        index = list(self._columns).index(colName)
+        rows = self._rows
+        if isinstance(rows, _RowsView):
+            rows = rows._rows
+        if isinstance(rows, _ColumnarRows):
+            return isinstance(rows._columns[index], array)
+        return set(map(type, map(itemgetter(index), self._rows))) <= {colType}
+
+    def _getSortKey(self, colName, reverse):
+        """ Return an array whose ascending order is the order of the
+        values of a column, used for lexsort.
+        """
+        colType = self._columns[colName].getType()
+        if colType in (int, float) and self._hasOnlyType(colName, colType):
+            try:
+                colArray = self.getColumnArray(colName)
+                return -colArray if reverse else colArray
+            except OverflowError:
+                pass  # Integers beyond int64 are sorted by their rank
+
+        # Sort only the distinct values and use their rank
+        codes, values = self.getColumnCodes(colName)
+        ranks = np.empty(len(values), dtype=np.int32)
+        ranks[sorted(range(len(values)), key=values.__getitem__)] = \
+            np.arange(len(values), dtype=np.int32)
+        return -ranks[codes] if reverse else ranks[codes]
+
+    def sort(self, key, reverse=False, cancel=None):
         """ Sort the table in place using the provided key.
-        If key is a string, it should be the name of one column. """
-        keyFunc = lambda r: getattr(r, key) if isinstance(key, str) else key
-        self._rows.sort(key=keyFunc, reverse=reverse)
+        Args:
+            key: name of a column, a list of column names (from the main
+                key to the last one) or a function called with each row.
+            reverse: If true reverse the sort order. It can also be a list
+                with a value for each column name in key.
+            cancel: optional CancelToken checked while sorting, the table is
+                left unchanged if it is cancelled.
+        The order of the rows is computed with argsort (vectorized when
+        NumPy is available) and then applied once.
+        """
+        self._checkMutable()
+        order = self.argsort(key, reverse=reverse, cancel=cancel)
+        if np is not None and isinstance(order, np.ndarray):
+            order = order.tolist()
+        with _bulkAllocation():
+            # A new list, since views can share the current one
+            self._rows = list(map(self._rows.__getitem__, order))
 
     @staticmethod
     def iterRows(fileName, key=None, reverse=False, **kwargs):
@@ -530,14 +1829,20 @@ class Table(_ColumnsList):
                 tableName: can be used explicit instead of @ in the filename.
                 types: It can be a dictionary {columnName: columnType} pairs that
                     allows to specify types for certain columns in the internal reader
+                errors: 'raise', 'skip' or a list where the errors of the lines
+                    that can not be parsed will be collected.
+                stats: optional Stats object to be updated while reading.
+                progress: callback function(rows, bytes, fraction) called
+                    regularly while reading.
+                cancel: CancelToken to stop reading (raising Cancelled).
+                intern: True or a list with the names of the str columns
+                    whose repeated values are stored only once.
+                guessRows: number of rows used to guess the column types.
         """
-        if '@' in fileName:
-            tableName, fileName = fileName.split('@')
-        else:
-            tableName = kwargs.pop('tableName', None)
+        tableName, fileName = _splitFileName(fileName, kwargs)
 
         # Create a table iterator
-        with open(fileName) as f:
+        with _openFile(fileName) as f:
             reader = _Reader(f, tableName, **kwargs)
             if key is None:
                 for row in reader:
@@ -550,80 +1855,1811 @@ class Table(_ColumnsList):
                 for row in sorted(reader, key=keyFunc, reverse=reverse):
                     yield row
 
-    def __len__(self):
-        return self.size()
+    @staticmethod
+    def probe(inputFile):
+        """
+        Quickly inspect a star file without reading its rows.
 
-    def __iter__(self):
-        return iter(self._rows)
+        Only the header lines and the first row of each table are parsed,
+        the number of rows of the loop tables is counted with a buffered
+        scan of the raw bytes.
 
-    def __getitem__(self, item):
-        return self._rows[item]
+        Args:
+            inputFile: can be either a string (filename) or a file object
+                opened in binary mode. Compressed files are supported.
+        Returns:
+            An OrderedDict with {tableName: tableInfo} pairs, in the same
+            order of the file. Each tableInfo provides the columns (with
+            the guessed types) through the usual getColumns/getColumnNames
+            methods and the number of rows through size().
+        """
+        if isinstance(inputFile, str):
+            with _openFile(inputFile, 'rb') as f:
+                return _probeFile(f)
+        if not hasattr(inputFile, 'peek'):
+            inputFile = io.BufferedReader(inputFile, _BUFFER_SIZE)
+        return _probeFile(inputFile)
 
-    def __setitem__(self, key, value):
-        self._rows[key] = value
+    @staticmethod
+    async def aiterRows(fileName, key=None, reverse=False,
+                        chunkSize=_CHUNK_SIZE, executor=None, **kwargs):
+        """
+        Asynchronous version of iterRows, to be used with 'async for'.
 
+        Rows are read and parsed in chunks in the given executor (or the
+        default thread pool of the event loop), so the event loop is only
+        blocked to hand over each chunk of rows.
 
-# --------- Helper functions  ------------------------
+        Args:
+            fileName: the input star filename, it might contain the '@'
+                to specify the tableName
+            key: key function to sort elements, it can also be a string that
+                will be used to retrieve the value of the column with that name.
+            reverse: If true reverse the sort order.
+            chunkSize: number of rows read in the executor at once.
+            executor: a concurrent.futures executor, if None the default
+                executor of the event loop is used.
+            **kwargs:
+                tableName: can be used explicit instead of @ in the filename.
+                types: It can be a dictionary {columnName: columnType} pairs that
+                    allows to specify types for certain columns in the internal reader
+                errors: 'raise', 'skip' or a list where the errors of the lines
+                    that can not be parsed will be collected.
+                stats: optional Stats object to be updated while reading.
+                progress: callback function(rows, bytes, fraction) called
+                    regularly while reading.
+                cancel: CancelToken to stop reading (raising Cancelled).
+                intern: True or a list with the names of the str columns
+                    whose repeated values are stored only once.
+                guessRows: number of rows used to guess the column types.
+        """
+        loop = asyncio.get_running_loop()
+
+        if key is not None:
+            # Sorting requires all rows, so read all of them at once
+            rows = await loop.run_in_executor(executor, lambda: list(
+                Table.iterRows(fileName, key=key, reverse=reverse, **kwargs)))
+            for row in rows:
+                yield row
+            return
+
+        tableName, fileName = _splitFileName(fileName, kwargs)
+        f = await loop.run_in_executor(executor, _openFile, fileName)
 
-def _guessType(strValue):
-    try:
-        int(strValue)
-        return int
-    except ValueError:
         try:
-            float(strValue)
-            return float
-        except ValueError:
-            return str
+            reader = await loop.run_in_executor(executor, functools.partial(
+                _Reader, f, tableName, **kwargs))
+            rows = await loop.run_in_executor(executor, reader.readRows,
+                                              chunkSize)
+            while rows:
+                for row in rows:
+                    yield row
+                rows = await loop.run_in_executor(executor, reader.readRows,
+                                                  chunkSize)
+        finally:
+            f.close()
 
+    @staticmethod
+    def splitBy(fileName, colName, outputPattern, copyTables=None,
+                processes=1, **kwargs):
+        """
+        Split the rows of a table into several star files, one for each
+        distinct value of a given column. The input table is read only once.
 
-def _formatValue(v):
-    return '%0.6f' % v if isinstance(v, float) else str(v)
+        Args:
+            fileName: the input star filename, it might contain the '@'
+                to specify the tableName
+            colName: name of the column used to route the rows, e.g.
+                rlnClassNumber or rlnRandomSubset.
+            outputPattern: format string that will be formatted with the
+                column value to get the output filename
+                (e.g. 'class{:03d}.star'), or a function that receives the
+                value and returns the output filename.
+            copyTables: list of other tables (e.g. ['optics']) that will be
+                written before the split table in every output file. If
+                None, all the other tables of the input file are copied.
+            processes: if greater than 1, the output files are formatted and
+                written by that number of worker processes. The rows are
+                sent to the workers in batches of up to _CHUNK_SIZE rows,
+                so at most two batches of each output are kept in memory.
+            **kwargs:
+                tableName: can be used explicit instead of @ in the filename.
+                types: It can be a dictionary {columnName: columnType} pairs that
+                    allows to specify types for certain columns in the internal reader
+        Returns:
+            An OrderedDict with {value: outputFilename} pairs.
+        """
+        tableName, fileName = _splitFileName(fileName, kwargs)
 
+        # Name of the split table, needed to exclude it from the header
+        with _openFile(fileName, 'rb') as f:
+            tableName = _findTable(f, tableName)
 
-def _getFormatStr(v):
-    return '.6f' if isinstance(v, float) else ''
+        header = _tablesToString(fileName, tableName, copyTables)
 
+        if isinstance(outputPattern, str):
+            outputPattern = outputPattern.format
 
+        with _openFile(fileName) as f:
+            reader = _Reader(f, tableName, **kwargs)
 
-if __name__ == '__main__':
+            if not reader.hasColumn(colName):
+                raise Exception("Non-existing column: %s" % colName)
 
-    parser = argparse.ArgumentParser(
-        description="Script to manipulate metadata files.")
+            columns = list(reader.getColumns())
+            index = reader.getColumnNames().index(colName)
 
-    add = parser.add_argument  # shortcut
-    add("input", help="Input metadata filename. ", nargs='?', default="")
-    add("output",
-        help="Output metadata filename, if no provided, print to stdout. ",
-        nargs='?', default="")
+            if processes <= 1:
+                writer = _SplitWriter(header, tableName, columns)
+                for values in reader.iterValues():
+                    key = values[index]
+                    writer.writeRowValues(key, outputPattern(key), values)
+                return writer.close()
 
-    add("-l", "--limit", type=int, default=0,
-        help="Limit the number of rows processed, useful for testing. ")
+            outputs = OrderedDict()
+            batches = {}
+            pending = {}  # {key: future of the last batch of the output}
 
-    args = parser.parse_args()
+            with ProcessPoolExecutor(processes) as executor:
 
-    if '@' in args.input:
-        tableName, fileName = args.input.split('@')
-    else:
-        tableName, fileName = None, args.input
+                def _submit(key, last=False):
+                    previous = pending.get(key)
+                    if previous is not None:
+                        previous.result()  # Batches are written in order
+                    pending[key] = executor.submit(_writeShard, (
+                        outputs[key], header, tableName, columns,
+                        batches.pop(key, []), previous is None, last))
 
-    if not os.path.exists(fileName):
-        raise Exception("Input file '%s' does not exists. " % fileName)
+                for values in reader.iterValues():
+                    key = values[index]
+                    if key not in outputs:
+                        outputs[key] = outputPattern(key)
+                    batch = batches.setdefault(key, [])
+                    batch.append(values)
+                    if len(batch) == _CHUNK_SIZE:
+                        _submit(key)
 
-    tableIn = Table(fileName=fileName, tableName=tableName)
+                for key in outputs:
+                    _submit(key, last=True)
 
-    # Create another table with same columns
-    tableOut = Table(columns=[str(c) for c in tableIn.getColumns()])
+                for future in pending.values():
+                    future.result()
 
-    limit = args.limit
+            return outputs
 
-    for i, row in enumerate(tableIn):
-        if 0 < limit == i:
-            break
+    @staticmethod
+    def concat(fileNames, outputFile=None, tableName=None, key=None,
+               reverse=False, copyTables=None, progress=None, cancel=None):
+        """
+        Concatenate the same table from many star files.
+
+        The columns of all inputs are validated from their headers before
+        any row is read. When writing to an output file without a key, the
+        rows are copied straight through without parsing them. If a key is
+        provided, all inputs should be already sorted by that key and their
+        rows are merged to keep the result sorted.
+
+        When the rows are parsed, the types of the columns are guessed from
+        the first rows of all inputs (e.g. float if any input has floats
+        in a column where others have ints). If an input still needs to
+        promote a column later, all inputs are parsed again with the final
+        types (reporting no progress, only checking cancellation).
+
+        Args:
+            fileNames: list of input star filenames.
+            outputFile: if provided, the output star filename where rows are
+                written, otherwise a new Table with all rows is returned.
+            tableName: name of the table to concatenate, if None the first
+                table of each file is used.
+            key: column name or key function to merge sorted inputs.
+            reverse: If true the inputs are sorted in descending order.
+            copyTables: list of other tables of the first input that will be
+                written before the concatenated table. If None, all the
+                other tables are copied.
+            progress: optional callback function(rows, bytes, fraction)
+                called regularly with the rows and bytes read from the
+                inputs. The fraction is None if any input is compressed.
+            cancel: optional CancelToken to stop the operation, Cancelled is
+                raised when the token is cancelled.
+        Returns:
+            A new Table if no outputFile was provided.
+        """
+        headers = []
+        monitor = None
+
+        if progress is not None or cancel is not None:
+            sizes = [None if _getCompression(fn, 'r') else os.path.getsize(fn)
+                     for fn in fileNames]
+            monitor = _Monitor(progress, cancel, totalBytes=None
+                               if None in sizes else sum(sizes))
+
+        for i, fn in enumerate(fileNames):
+            with _openFile(fn, 'rb') as f:
+                name = _findTable(f, tableName)
+                colNames, values, foundLoop, line = _readHeader(f)
+                headers.append((colNames, values, foundLoop))
+                if i == 0:
+                    firstName = name
+                elif colNames != headers[0][0]:
+                    raise Exception("Columns of table '%s' in file '%s' differ "
+                                    "from file '%s'"
+                                    % (name, fn, fileNames[0]))
+
+        if key is None:
+            keyFunc = None
+        elif isinstance(key, str):
+            keyFunc = lambda r: getattr(r, key)
+        else:
+            keyFunc = key
+
+        parseRows = keyFunc is not None or outputFile is None
+        # Guess the types from the first rows of all inputs (if the rows
+        # are parsed), each reader can still promote them while reading
+        types = None
+        noRows = False  # If types are from an input without rows
+        for fn in fileNames if parseRows else fileNames[:1]:
+            with _openFile(fn) as f:
+                reader = _Reader(f, tableName)
+            fileTypes = OrderedDict((c.getName(), c.getType())
+                                    for c in reader.getColumns())
+            if types is None or noRows:
+                types, noRows = fileTypes, reader._row is None
+            elif reader._row is not None:
+                types = OrderedDict((n, _widestType([t, fileTypes[n]]))
+                                    for n, t in types.items())
+
+        while True:
+            columns = [_Column(n, t) for n, t in types.items()]
+            try:
+                return _concatRows(fileNames, outputFile, tableName,
+                                   firstName, headers, columns, keyFunc,
+                                   reverse, copyTables, monitor, parseRows)
+            except _PromotedTypes as e:
+                # Some input promoted columns after its first rows, parse
+                # all of them again with the wider types, so the output is
+                # only written by a pass where types did not change
+                types = OrderedDict((n, _widestType([t, e.types[n]]))
+                                    for n, t in types.items())
+                monitor = None if cancel is None else _Monitor(cancel=cancel)
+
+    @staticmethod
+    def iterChunks(fileName, chunkSize=_CHUNK_SIZE, asArrays=False, **kwargs):
+        """
+        Iterate over the rows of a given table in batches of columns.
+
+        Args:
+            fileName: the input star filename, it might contain the '@'
+                to specify the tableName
+            chunkSize: maximum number of rows of each batch.
+            asArrays: if True, the values of each column are returned as
+                a NumPy array instead of a list (NumPy is required).
+            **kwargs:
+                tableName: can be used explicit instead of @ in the filename.
+                types: It can be a dictionary {columnName: columnType} pairs that
+                    allows to specify types for certain columns in the internal reader
+                errors: 'raise', 'skip' or a list where the errors of the lines
+                    that can not be parsed will be collected.
+                stats: optional Stats object to be updated while reading.
+                progress: callback function(rows, bytes, fraction) called
+                    regularly while reading.
+                cancel: CancelToken to stop reading (raising Cancelled).
+                intern: True or a list with the names of the str columns
+                    whose repeated values are stored only once.
+                guessRows: number of rows used to guess the column types.
+        Returns:
+            An iterator of OrderedDict with {columnName: values} pairs.
+        """
+        if asArrays and np is None:
+            raise Exception("NumPy is required to read columns as arrays.")
+
+        tableName, fileName = _splitFileName(fileName, kwargs)
+
+        with _openFile(fileName) as f:
+            reader = _Reader(f, tableName, **kwargs)
+            colNames = reader.getColumnNames()
+            columns = reader.readChunk(chunkSize)
+
+            while columns is not None:
+                if asArrays:
+                    columns = [_toArray(v, t)
+                               for v, t in zip(columns, reader._types)]
+                yield OrderedDict(zip(colNames, columns))
+                columns = reader.readChunk(chunkSize)
+
+    @staticmethod
+    def fromColumns(columns, types=None):
+        """
+        Create a new table from the values of each column.
+
+        Args:
+            columns: dict (or list of pairs) with {columnName: values},
+                where values can be a list or a NumPy array. All columns
+                should have the same number of values.
+            types: It can be a dictionary {columnName: columnType} pairs that
+                allows to specify types for certain columns. By default, the
+                type is taken from the array dtype or the first value.
+        Returns:
+            A new Table with the rows built from the columns values.
+        """
+        items = list(OrderedDict(columns).items())
+        types = types or {}
+        sizes = set(len(values) for _, values in items)
+
+        if len(sizes) > 1:
+            raise Exception("All columns should have the same number of "
+                            "values, found sizes: %s" % sorted(sizes))
+
+        tableColumns = []
+        allValues = []
+
+        for colName, values in items:
+            colType = types.get(colName)
+            if np is not None and isinstance(values, np.ndarray):
+                if colType is None:
+                    colType = _getColumnType(values.dtype)
+                if values.dtype != object and colType in (int, float, str):
+                    # Convert the values to python objects all at once
+                    dtype = (_getDtype(colType) if colType in (int, float)
+                             else str)
+                    values = values.astype(dtype, copy=False).tolist()
+                else:
+                    # Objects (e.g. ImageLocation tuples) are kept as items
+                    values = values.tolist()
+                    if any(type(v) is not colType for v in values):
+                        values = list(map(colType, values))
+            elif colType is None:
+                colType = type(values[0]) if len(values) else str
+            elif any(type(v) is not colType for v in values):
+                values = list(map(colType, values))
+            tableColumns.append(_Column(colName, colType))
+            allValues.append(values)
+
+        return _createTable(tableColumns, allValues)
+
+    @staticmethod
+    def fromDataFrame(df, types=None):
+        """
+        Create a new table from a pandas DataFrame (the index is ignored).
+
+        Args:
+            df: the DataFrame, with the names of the columns as labels.
+            types: It can be a dictionary {columnName: columnType} pairs that
+                allows to specify types for certain columns. By default,
+                integer and float dtypes are int and float columns and
+                the others are str columns.
+        """
+        return Table.fromColumns([(str(colName), df[colName].to_numpy())
+                                  for colName in df.columns], types=types)
+
+    @staticmethod
+    def fromArrow(arrowTable, types=None):
+        """
+        Create a new table from a pyarrow Table.
+
+        Args:
+            arrowTable: the pyarrow Table.
+            types: It can be a dictionary {columnName: columnType} pairs that
+                allows to specify types for certain columns. By default,
+                integer and floating point columns are int and float
+                columns and the others are str columns.
+        """
+        pa = _importOptional('pyarrow')
+        columns = []
+
+        for colName, column in zip(arrowTable.column_names,
+                                   arrowTable.columns):
+            if (pa.types.is_integer(column.type) or
+                    pa.types.is_floating(column.type)):
+                values = column.to_numpy()
+            else:
+                values = list(map(str, column.to_pylist()))
+            columns.append((colName, values))
+
+        return Table.fromColumns(columns, types=types)
+
+    @staticmethod
+    def readParquet(fileName, columns=None, types=None):
+        """
+        Read a table from a Parquet file written by writeParquet
+        (pyarrow is required).
+
+        Args:
+            fileName: input Parquet file name.
+            columns: list with the names of the columns to read,
+                if None, all columns are read.
+            types: It can be a dictionary {columnName: columnType} pairs that
+                allows to specify types for certain columns.
+        """
+        arrowTable = _importOptional('pyarrow.parquet').read_table(
+            fileName, columns=columns)
+        return Table.fromArrow(arrowTable, types=types)
+
+    @staticmethod
+    def getParquetTableName(fileName):
+        """ Return the name of the star table stored in a Parquet file
+        by writeParquet, without reading its data.
+        """
+        schema = _importOptional('pyarrow.parquet').read_schema(fileName)
+        metadata = schema.metadata or {}
+        return metadata.get(_ARROW_TABLE_NAME.encode(), b'').decode() or None
+
+    def __len__(self):
+        return self.size()
+
+    def __iter__(self):
+        return iter(self._rows)
+
+    def __getitem__(self, item):
+        """ Return the row at a given index. If item is a slice, a list of
+        indexes or a mask (a list or NumPy array with a bool for each row),
+        a view with these rows is returned (see select).
+        """
+        if isinstance(item, slice):
+            return self._createView(range(len(self._rows))[item])
+        if isinstance(item, (list, tuple)) or (
+                np is not None and isinstance(item, np.ndarray)):
+            return self._createView(self._getIndexes(item))
+        return self._rows[item]
+
+    def __setitem__(self, key, value):
+        self._checkMutable()
+        if self._rows is self._sharedRows:
+            # Copy the rows, so the views keep the current ones
+            self._rows = list(self._rows)
+        self._rows[key] = value
+
+    def select(self, predicate):
+        """ Return a view with the rows for which predicate(row) is True.
+
+        Views are tables that share the rows with their parent, so they
+        are cheap to create (also from other views). The rows are only
+        copied when the view (or its parent) is modified, so changes in
+        a view never affect its parent table, and the other way around.
+        """
+        return self._createView([i for i, row in enumerate(self._rows)
+                                 if predicate(row)])
+
+    def _getIndexes(self, item):
+        """ Return the list of row indexes given by a list of indexes or
+        by a mask with a bool value for each row.
+        """
+        n = len(self._rows)
+        if np is not None and isinstance(item, np.ndarray):
+            item = (np.flatnonzero(item) if item.dtype == bool
+                    and len(item) == n else item).tolist()
+        elif len(item) == n and all(isinstance(i, bool) for i in item):
+            return [i for i, m in enumerate(item) if m]
+
+        if any(isinstance(i, bool) for i in item):
+            raise Exception("Expected a mask with %d values, but found %d"
+                            % (n, len(item)))
+        indexes = [i + n if i < 0 else i for i in map(_asIndex, item)]
+        if indexes and not (0 <= min(indexes) and max(indexes) < n):
+            raise IndexError("Row index out of range")
+        return indexes
+
+    def _createView(self, indexes):
+        """ Create a table with the rows at these indexes of this one. """
+        table = Table(columns=[_Column(c.getName(), c.getType())
+                               for c in self.getColumns()])
+        table.Row = self.Row
+        table._rows = _RowsView(self._rows, indexes)
+        self._sharedRows = self._rows
+        return table
+
+    def __reduce__(self):
+        # Send the columns once and the values packed column-wise
+        columns = [_Column(c.getName(), c.getType()) for c in self.getColumns()]
+        return _unpickleTable, (columns, _packColumns(columns, self._rows),
+                                self.isFrozen())
+
+    def _checkMutable(self, replaceRows=False):
+        """ Raise an exception if the table can not be modified.
+        If replaceRows is True, the rows will be replaced instead of
+        modified, what is also allowed for rows stored by columns.
+        """
+        if self._frozen:
+            raise Exception("This table is frozen and can not be modified.")
+        if replaceRows:
+            return
+        if isinstance(self._rows, _ColumnarRows):
+            raise Exception("The values of this table are stored by columns "
+                            "and can not be modified.")
+        if isinstance(self._rows, _RowsView):
+            # Copy the rows of a view before it is modified
+            self._rows = list(self._rows)
+
+
+class SharedTable:
+    """
+    Handle to the data of a table stored in shared memory, as returned by
+    Table.share. Pickling it only sends the columns and the name of the
+    memory block, so it is cheap to pass to worker processes.
+    """
+    def __init__(self, columns, layout, size, shm):
+        self._columns = columns
+        self._layout = layout
+        self._size = size
+        self._shm = shm
+        self._name = shm.name
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_shm'] = None
+        return state
+
+    def __len__(self):
+        return self._size
+
+    def getColumns(self):
+        return self._columns
+
+    def getColumnNames(self):
+        return [c.getName() for c in self._columns]
+
+    def getColumnValues(self, colName):
+        """ Return the values of a single column, without building rows. """
+        index = self.getColumnNames().index(colName)
+        return self._unpack(self._layout[index])
+
+    def getColumnArray(self, colName, dtype=None):
+        """ Return the values of a single column as a NumPy array.
+        Arrays of int and float columns (if dtype is None or the same) are
+        read-only views of the shared memory, without any copy, so they
+        should be released before calling close().
+        Args:
+            colName: The name of an existing column to retrieve values.
+            dtype: NumPy dtype of the array (see Table.getColumnArray).
+        """
+        if np is None:
+            raise Exception("NumPy is required to get columns as arrays.")
+
+        index = self.getColumnNames().index(colName)
+        colType = self._columns[index].getType()
+        code, offset, length = self._layout[index]
+        dtype = _getDtype(colType, dtype)
+
+        if code in ('q', 'd') and np.dtype(code) == dtype:
+            values = np.frombuffer(self._getMemory().buf, dtype=dtype,
+                                   count=length // dtype.itemsize,
+                                   offset=offset)
+            values.flags.writeable = False
+            return values
+
+        return _valuesArray(self._unpack(self._layout[index]), dtype)
+
+    def getTable(self):
+        """ Build a frozen Table with the shared data. """
+        return _createTable(self._columns,
+                            [self._unpack(item) for item in self._layout],
+                            frozen=True)
+
+    def close(self):
+        """ Close the access to the shared memory from this process. """
+        if self._shm is not None:
+            self._shm.close()
+            self._shm = None
+
+    def unlink(self):
+        """ Release the shared memory block, it should be called only once
+        by the process that created it.
+        """
+        self._getMemory().unlink()
+        self.close()
+
+    def _getMemory(self):
+        if self._shm is None:
+            self._shm = _attachSharedMemory(self._name)
+        return self._shm
+
+    def _unpack(self, item):
+        code, offset, length = item
+        data = self._getMemory().buf[offset:offset + length]
+        try:
+            return _unpackColumn(code, data)
+        finally:
+            data.release()
+
+
+class _ColumnarRows:
+    """ Read-only sequence of rows whose values are stored by columns,
+    numbers in compact arrays. Rows are created when they are accessed.
+    """
+    def __init__(self, Row, columns, size):
+        self._Row = Row
+        self._columns = columns
+        self._size = size
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return list(map(self._Row._make,
+                            zip(*[c[item] for c in self._columns])))
+        if item < 0:
+            item += self._size
+        return self._Row._make([c[item] for c in self._columns])
+
+    def __iter__(self):
+        for i in range(0, self._size, _CHUNK_SIZE):
+            yield from self[i:i + _CHUNK_SIZE]
+
+    def getColumnValues(self, index):
+        return list(self._columns[index])
+
+    def getColumnArray(self, index, colType, dtype=None):
+        """ Return a column as a NumPy array. If dtype is None or it is the
+        type of the stored values, the array shares their memory.
+        """
+        values = self._columns[index]
+        if isinstance(values, array):
+            if dtype is None or np.dtype(dtype) == np.dtype(values.typecode):
+                result = np.frombuffer(values, dtype=values.typecode)
+                result.flags.writeable = False
+                return result
+        return _valuesArray(values, _getDtype(colType, dtype))
+
+
+class _RowsView:
+    """ Read-only sequence with the rows of another sequence at some
+    indexes (a range or a list), used by the views of tables.
+    """
+    def __init__(self, rows, indexes):
+        if isinstance(rows, _RowsView):
+            # Index the original rows, instead of chaining the views
+            indexes = (rows._indexes[_rangeSlice(indexes)]
+                       if isinstance(indexes, range)
+                       else list(map(rows._indexes.__getitem__, indexes)))
+            rows = rows._rows
+        self._rows = rows
+        self._indexes = indexes
+
+    def __len__(self):
+        return len(self._indexes)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return list(map(self._rows.__getitem__, self._indexes[item]))
+        return self._rows[self._indexes[item]]
+
+    def __iter__(self):
+        return map(self._rows.__getitem__, self._indexes)
+
+    def getColumnValues(self, index):
+        if isinstance(self._rows, _ColumnarRows):
+            values = self._rows._columns[index]
+            return list(map(values.__getitem__, self._indexes))
+        return list(map(itemgetter(index), self))
+
+    def getColumnArray(self, index, colType, dtype=None):
+        """ Return a column as a NumPy array. Views of a slice of columnar
+        rows share the memory of the stored values (see _ColumnarRows).
+        """
+        if isinstance(self._rows, _ColumnarRows):
+            values = self._rows.getColumnArray(index, colType, dtype)
+            if isinstance(self._indexes, range):
+                return values[_rangeSlice(self._indexes)]
+            return values[np.array(self._indexes, dtype=np.intp)]
+        return _columnArray(self, index, colType, dtype)
+
+
+class AccessPlan:
+    """
+    Order to read the images of a table with the best I/O locality, as
+    returned by Table.getAccessPlan: the rows are grouped by stack file
+    and sorted by slice index in each stack.
+
+    Attributes:
+        order: list with the indexes of the rows in the order of the plan.
+        slices: list with the slice index of each row in the plan order
+            (0 for images that are not in a stack).
+        groups: list of (path, start, end) tuples, the rows of the stack
+            file path are order[start:end].
+
+    Iterating over the plan gives a (path, rows, slices) tuple for each
+    stack file, with the indexes of the rows and their slices:
+
+        plan = table.getAccessPlan()
+        images = [readImage(path, i) for path, _, slices in plan
+                  for i in slices]
+        images = plan.restore(images)  # same order of the table rows
+    """
+    def __init__(self, order, slices, groups):
+        self.order = order
+        self.slices = slices
+        self.groups = groups
+
+    def __len__(self):
+        return len(self.order)
+
+    def __iter__(self):
+        for path, start, end in self.groups:
+            yield path, self.order[start:end], self.slices[start:end]
+
+    def getShards(self, n):
+        """ Split the plan into n parts with the same number of rows (or
+        less parts if there are less rows). Stacks are kept in the same
+        order, so only the stacks at the limits between parts are read by
+        two of them, and the results of all parts can be concatenated
+        before calling restore.
+        Returns:
+            A list of AccessPlan, whose order has indexes of this table.
+        """
+        size = len(self.order)
+        n = max(1, min(n, size))
+        limits = [size * i // n for i in range(n + 1)]
+        shards = []
+
+        for first, last in zip(limits, limits[1:]):
+            groups = [(path, max(start, first) - first, min(end, last) - first)
+                      for path, start, end in self.groups
+                      if start < last and end > first]
+            shards.append(AccessPlan(self.order[first:last],
+                                     self.slices[first:last], groups))
+
+        return shards
+
+    def restore(self, results):
+        """ Return the results obtained in the plan order as a list in the
+        original order of the rows.
+        """
+        if len(results) != len(self.order):
+            raise Exception("Expected %d results, but got %d"
+                            % (len(self.order), len(results)))
+
+        output = [None] * len(results)
+        for i, result in zip(self.order, results):
+            output[i] = result
+        return output
+
+
+# --------- Helper functions  ------------------------
+
+def _guessType(strValue):
+    try:
+        int(strValue)
+        return int
+    except ValueError:
+        try:
+            float(strValue)
+            return float
+        except ValueError:
+            return str
+
+
+# Types of guessed columns, in the order they are promoted
+_PROMOTIONS = (int, float, str)
+
+
+def _guessColumnType(values, colType=int, allowStr=True):
+    """ Return the first type, from colType in (int, float, str), that
+    can convert all the given string values. If allowStr is False, the
+    values that are not numbers are ignored and str is never returned.
+    """
+    if not allowStr:
+        values = [v for v in values if _guessType(v) is not str]
+    types = (int, float)
+    for t in types[types.index(colType):] if colType in types else ():
+        try:
+            deque(map(t, values), maxlen=0)
+            return t
+        except ValueError:
+            pass
+    return str
+
+
+def _guessTypes(colNames, rows, allowStr=True):
+    """ Guess the type of the columns from some rows of string values.
+    The rows with a wrong number of values are ignored. If allowStr is
+    False, only the columns whose first value is not a number are str.
+    Returns:
+        A dict {columnName: columnType}.
+    """
+    rows = [values for values in rows if len(values) == len(colNames)]
+    if not rows:
+        return {}
+    return {colName: _guessColumnType(values, int, allowStr or
+                                      _guessType(values[0]) is str)
+            for colName, values in zip(colNames, zip(*rows))}
+
+
+def _splitLine(line):
+    """ Split values of a line, using shlex only if there are quotes. """
+    return shlex.split(line) if re.search(r'\'|\"+', line) else line.split()
+
+
+# Buffer size used when scanning the raw bytes of files
+_BUFFER_SIZE = 1 << 20
+# Maximum number of files that are merged at once
+_MERGE_MAX_FILES = 256
+# Supported compressions and the magic numbers of their files
+_COMPRESSIONS = OrderedDict([('gz', b'\x1f\x8b'),
+                             ('bz2', b'BZh'),
+                             ('xz', b'\xfd7zXZ\x00'),
+                             ('zst', b'\x28\xb5\x2f\xfd')])
+# Number of threads used by compressors that support it
+_COMPRESSION_THREADS = min(4, os.cpu_count() or 1)
+# Lines that mark the end of a loop table: blank lines or a new data_ block.
+# The second one also matches the previous newline, that makes the search
+# much faster than using a multi-line regex with ^
+_END_LINE_RE = re.compile(rb'[ \t\r\f\v]*(?:\n|data_)')
+_TABLE_END_RE = re.compile(rb'\n[ \t\r\f\v]*(?:\n|data_)')
+
+
+def _probeFile(inputFile):
+    """ Return the info of all tables in the given binary file. """
+    infos = OrderedDict()
+    line = inputFile.readline()
+
+    while line:
+        line = line.strip()
+        if line.startswith(b'data_'):
+            tableName = line[5:].decode()
+            infos[tableName], line = _probeTable(inputFile, tableName)
+        else:
+            line = inputFile.readline()
+
+    return infos
+
+
+def _probeTable(inputFile, tableName):
+    """ Parse the header of a table and count its rows. The file should be
+    positioned just after the data_ line.
+    Returns the table info and the line following the table (empty at the
+    end of the file).
+    """
+    colNames, values, foundLoop, line = _readHeader(inputFile)
+
+    if not foundLoop:
+        size = 1 if colNames else 0
+    else:
+        stripped = line.strip()
+        if not stripped or stripped.startswith(b'data_'):
+            size = 0
+        else:
+            values = _splitLine(stripped.decode())
+            size, line = _scanLines(inputFile)
+            size += 1
+
+    columns = [_Column(colName, _guessType(values[i]) if values else str)
+               for i, colName in enumerate(colNames)]
+    singleRow = not foundLoop and bool(colNames)
+
+    return _TableInfo(tableName, columns, size, singleRow), line
+
+
+def _findTable(inputFile, tableName):
+    """ Move the binary file pointer after the data_ line of the given
+    table, or of the first table if tableName is None.
+    Returns the name of the table found.
+    """
+    dataStr = ('data_%s' % (tableName or '')).encode()
+    line = inputFile.readline()
+
+    while line:
+        if line.startswith(dataStr):
+            return line.strip()[5:].decode()
+        line = inputFile.readline()
+
+    raise Exception("'%s' block was not found" % dataStr.decode())
+
+
+def _readHeader(inputFile):
+    """ Parse the column labels of a table from a binary file positioned
+    after the data_ line of the table.
+    Returns:
+        A tuple (colNames, values, foundLoop, line), where values are only
+        filled for single-row tables and line is the first line after
+        the labels.
+    """
+    foundLoop = False
+    colNames = []
+    values = []
+
+    # Find first column line, the table could also be empty
+    line = inputFile.readline()
+    while line:
+        stripped = line.strip()
+        if stripped.startswith(b'_'):
+            break
+        elif stripped.startswith(b'loop_'):
+            foundLoop = True
+        elif stripped.startswith(b'data_'):
+            return colNames, values, False, line
+        line = inputFile.readline()
+
+    while line.strip().startswith(b'_'):
+        parts = _splitLine(line.strip().decode())
+        colNames.append(parts[0][1:])
+        if not foundLoop:
+            values.append(parts[1])
+        line = inputFile.readline()
+
+    return colNames, values, foundLoop, line
+
+
+def _scanLines(inputFile, outputFile=None, monitor=None):
+    """ Count the remaining lines of a loop table by scanning the raw bytes
+    in big chunks instead of parsing line by line.
+    Args:
+        inputFile: buffered binary file positioned at a line of the table.
+        outputFile: if not None, the lines are also written to this
+            text file.
+        monitor: optional _Monitor updated after each chunk.
+    Returns:
+        The number of lines and the line following the table.
+    """
+    count = 0
+
+    while True:
+        # Look at the buffered bytes and only consume the table lines
+        chunk = inputFile.peek(_BUFFER_SIZE)
+        size = chunk.rfind(b'\n') + 1
+
+        if size:
+            chunk = chunk[:size]
+        else:  # No complete line is buffered
+            chunk = inputFile.readline()
+            if not chunk:
+                return count, b''
+            if not chunk.endswith(b'\n'):  # last line of the file
+                chunk += b'\n'
+
+        if _END_LINE_RE.match(chunk):
+            end = 0
+        else:
+            m = _TABLE_END_RE.search(chunk)
+            end = m.start() + 1 if m else len(chunk)
+        n = chunk.count(b'\n', 0, end)
+        count += n
+
+        if outputFile is not None:
+            outputFile.write(chunk[:end].decode())
+        if monitor is not None:
+            monitor.update(n, end)
+
+        if end < len(chunk):
+            if not size:
+                return count, chunk
+            inputFile.read(end)
+            return count, inputFile.readline()
+
+        if size:
+            inputFile.read(size)
+
+
+def _tablesToString(fileName, exclude=None, tableNames=None):
+    """ Return the star text of some tables of a file.
+    Args:
+        exclude: name of a table that should not be included.
+        tableNames: list with the names of the tables to include,
+            if None, all tables are included.
+    """
+    output = StringIO()
+
+    for name, info in Table.probe(fileName).items():
+        if name != exclude and (tableNames is None or name in tableNames):
+            Table(fileName=fileName, tableName=name).writeStar(
+                output, tableName=name, singleRow=info.isSingleRow())
+
+    return output.getvalue()
+
+
+def _concatRows(fileNames, outputFile, tableName, firstName, headers,
+                columns, keyFunc, reverse, copyTables, monitor,
+                guessTypes=False):
+    """ Read or copy the rows of the inputs of concat. The types of
+    the columns and guessTypes are used as in _iterFileRows.
+    """
+    types = {c.getName(): c.getType() for c in columns}
+
+    with tempfile.TemporaryDirectory() as tmpDir:
+        if keyFunc is not None:
+            rows = _iterMerged(fileNames, tableName, columns, keyFunc,
+                               reverse, tmpDir, monitor, guessTypes)
+        elif outputFile is None:
+            rows = (row for fn in fileNames
+                    for row in _iterFileRows(fn, tableName, types,
+                                             monitor, guessTypes))
+        else:
+            rows = None
+
+        if outputFile is None:
+            table = Table(columns=columns)
+            table._rows = list(map(table.Row._make, rows))
+            if monitor is not None:
+                monitor.done()
+            return table
+
+        with _openFile(outputFile, 'w') as f:
+            f.write(_tablesToString(fileNames[0], firstName, copyTables))
+            writer = _Writer(f)
+            writer.writeTableName(firstName)
+            writer.writeHeader(columns)
+
+            if rows is not None:
+                for row in rows:
+                    writer.writeRowValues(row)
+            else:
+                for fn, (_, values, foundLoop) in zip(fileNames, headers):
+                    if not foundLoop:
+                        if values:
+                            f.write(' '.join(values) + '\n')
+                        continue
+                    with _openFile(fn, 'rb') as fIn:
+                        _findTable(fIn, tableName)
+                        line = _readHeader(fIn)[3].strip()
+                        if line and not line.startswith(b'data_'):
+                            f.write(line.decode() + '\n')
+                            _scanLines(fIn, f, monitor)
+
+            writer.writeNewline()
+
+        if monitor is not None:
+            monitor.done()
+
+
+class _PromotedTypes(Exception):
+    """ Raised while reading the inputs of concat when a reader promotes
+    the types of some columns, given in the types dict.
+    """
+    def __init__(self, types):
+        Exception.__init__(self, "Promoted column types")
+        self.types = types
+
+
+def _iterFileRows(fileName, tableName, types, monitor=None, guessTypes=False):
+    """ Iterate over the rows of a table in the given file.
+    If a _Monitor is given, it is shared by the readers of many files.
+    Args:
+        types: dict {columnName: columnType} with the types of the columns.
+        guessTypes: if True, the types are only the initial ones: the
+            reader guesses the types and _PromotedTypes is raised (with
+            the reader types) as soon as it promotes any column.
+    """
+    with _openFile(fileName) as f:
+        if not guessTypes:
+            reader = _Reader(f, tableName, types=types)
+        else:
+            reader = _Reader(f, tableName)
+            reader._widenTypes(types)
+        reader._monitor = monitor
+        for row in reader:
+            if reader._promoted:
+                break
+            yield row
+
+        if reader._promoted:
+            raise _PromotedTypes({c.getName(): c.getType()
+                                  for c in reader.getColumns()})
+
+
+def _widestType(types):
+    """ Return the type, of int, float and str, that can hold the values
+    of all these types.
+    """
+    return max(types, key=_PROMOTIONS.index)
+
+
+def _iterMerged(fileNames, tableName, columns, keyFunc, reverse, tmpDir,
+                monitor=None, guessTypes=False):
+    """ Merge the rows of many files with tables sorted by the same key.
+    If there are too many files to keep them open at once, groups of
+    files are merged first into temporary files in tmpDir.
+    The monitor is updated while reading the input files, but not the
+    temporary ones (that are only checked for cancellation).
+    The types of the columns and guessTypes are used as in _iterFileRows.
+    """
+    types = {c.getName(): c.getType() for c in columns}
+
+    while len(fileNames) > _MERGE_MAX_FILES:
+        mergedFiles = []
+        for i in range(0, len(fileNames), _MERGE_MAX_FILES):
+            group = fileNames[i:i + _MERGE_MAX_FILES]
+            mergedFile = os.path.join(tmpDir, 'merged_%06d.star'
+                                      % len(os.listdir(tmpDir)))
+            with _openFile(mergedFile, 'w') as f:
+                writer = _Writer(f)
+                writer.writeTableName(tableName)
+                writer.writeHeader(columns)
+                for row in _iterMerged(group, tableName, columns, keyFunc,
+                                       reverse, tmpDir, monitor, guessTypes):
+                    writer.writeRowValues(row)
+                writer.writeNewline()
+            mergedFiles.append(mergedFile)
+        fileNames = mergedFiles
+        if monitor is not None:
+            monitor = _Monitor(cancel=monitor.cancel)
+
+    iterators = [_iterFileRows(fn, tableName, types, monitor, guessTypes)
+                 for fn in fileNames]
+    return heapq.merge(*iterators, key=keyFunc, reverse=reverse)
+
+
+# Array typecodes of the dtypes allowed for columnar tables
+_TYPECODES = OrderedDict([('int8', 'b'), ('int16', 'h'), ('int32', 'i'),
+                          ('int64', 'q'), ('float32', 'f'), ('float64', 'd')])
+
+
+def _readColumnar(reader, precision, dtypes):
+    """ Read the rows of a reader storing the values by columns.
+    Args:
+        precision: None or 'compact' (see Table.readStar).
+        dtypes: dict {columnName: dtype} for some columns.
+    """
+    if precision not in (None, 'compact'):
+        raise Exception("Invalid precision: %s" % precision)
+
+    columns = []
+    promote = []  # Columns whose int type is promoted when needed
+    types = list(reader._types)
+    colDtypes = []  # Normalized dtypes given for each column, or None
+
+    for col in reader.getColumns():
+        colType = col.getType()
+        dtype = dtypes.get(col.getName())
+        if dtype is not None:
+            dtype = str(np.dtype(dtype)) if np is not None else dtype
+            if dtype not in _TYPECODES:
+                raise Exception("Invalid dtype for column %s: %s"
+                                % (col.getName(), dtype))
+            code = _TYPECODES[dtype]
+            _checkColumnDtype(col.getName(), colType, dtype)
+        elif colType is float:
+            code = 'f' if precision else 'd'
+        elif colType is int:
+            code = 'b' if precision else 'q'
+        else:
+            code = None
+        columns.append(array(code) if code else [])
+        promote.append(dtype is None and code == 'b')
+        colDtypes.append(dtype)
+
+    size = 0
+    values = reader.readChunk(_CHUNK_SIZE)
+
+    while values is not None:
+        size += len(values[0]) if values else 0
+        for i, v in enumerate(values):
+            if types[i] is not reader._types[i]:
+                # The reader promoted the type of this column
+                types[i] = reader._types[i]
+                if colDtypes[i] is not None:
+                    _checkColumnDtype(reader.getColumnNames()[i], types[i],
+                                      colDtypes[i])
+                code = (_TYPECODES[colDtypes[i]] if colDtypes[i]
+                        else 'f' if precision else 'd')
+                columns[i] = (list(map(str, columns[i])) if types[i] is str
+                              else array(code, columns[i]))
+                promote[i] = False
+            if types[i] is str and i in reader._promoted:
+                v = list(map(str, v))  # Values converted before promotion
+            columns[i] = _extendColumn(columns[i], v, promote[i])
+        values = reader.readChunk(_CHUNK_SIZE)
+
+    strColumns = [i for i in reader._promoted if types[i] is str]
+    rows = reader._reparse() if strColumns else None
+    if rows is not None:
+        # Keep the original text of the values read before the promotion
+        for i in strColumns:
+            columns[i] = list(map(itemgetter(i), rows))
+
+    return _ColumnarRows(reader.Row, columns, size)
+
+
+def _checkColumnDtype(colName, colType, dtype):
+    """ Raise an exception if the values of a column of the given type
+    can not be stored with the dtype (one of _TYPECODES).
+    """
+    if colType not in (int, float) or (colType is float and 'int' in dtype):
+        raise Exception("Invalid dtype for column %s of type %s: %s"
+                        % (colName, colType.__name__, dtype))
+
+
+def _extendColumn(column, values, promote=False):
+    """ Add the values to a column (list or array). If promote is True,
+    the type of an int array is changed to a bigger one if needed.
+    Returns:
+        The column with the new values, that could be a new array.
+    """
+    if promote and values:
+        low, high = min(values), max(values)
+        codes = 'bhiq'
+        for code in codes[codes.index(column.typecode):]:
+            limit = 1 << (array(code).itemsize * 8 - 1)
+            if -limit <= low and high < limit:
+                break
+        if code != column.typecode:
+            column = array(code, column)
+
+    column.extend(values)
+    return column
+
+
+def _cancellable(func, cancel):
+    """ Wrap the function to check the CancelToken every _CHUNK_SIZE calls.
+    """
+    counter = [0]
+
+    def _func(*args):
+        counter[0] += 1
+        if counter[0] % _CHUNK_SIZE == 0:
+            cancel.check()
+        return func(*args)
+
+    cancel.check()
+    return _func
+
+
+def _splitFileName(fileName, kwargs):
+    """ Return the table name and the file name from a 'tableName@fileName'
+    string, or take the table name from kwargs if not in the filename.
+    """
+    if '@' in fileName:
+        tableName, fileName = fileName.split('@')
+        return tableName, fileName
+    return kwargs.pop('tableName', None), fileName
+
+
+def _writeShard(args):
+    """ Write a batch of rows of a table to a star file. The first batch
+    creates the file with the header, the other ones are appended.
+    Used as the worker function when splitting tables in parallel.
+    """
+    fileName, header, tableName, columns, rows, first, last = args
+
+    with _openFile(fileName, 'w' if first else 'a') as f:
+        writer = _Writer(f)
+        if first:
+            f.write(header)
+            writer.writeTableName(tableName)
+            writer.writeHeader(columns)
+        for values in rows:
+            writer.writeRowValues(values)
+        if last:
+            writer.writeNewline()
+
+
+def _getFileSize(f):
+    """ Return the size of an opened regular (uncompressed) file,
+    or None if it is unknown.
+    """
+    raw = getattr(getattr(f, 'buffer', f), 'raw', None)
+    if not isinstance(raw, io.FileIO):
+        return None
+    try:
+        st = os.fstat(raw.fileno())
+    except OSError:
+        return None
+    return st.st_size if stat.S_ISREG(st.st_mode) else None
+
+
+def _isStarFile(fileName):
+    """ Return True if the filename has a star extension, that could be
+    followed by a compression extension.
+    """
+    root, ext = os.path.splitext(fileName)
+    if ext[1:] in _COMPRESSIONS:
+        root, ext = os.path.splitext(root)
+    return ext == '.star'
+
+
+def _getCompression(fileName, mode):
+    """ Return the compression of a file (gz, bz2, xz or zst) or None.
+    It is detected from the first bytes when reading and from the
+    filename extension when writing.
+    """
+    if 'r' in mode:
+        with open(fileName, 'rb') as f:
+            return _detectCompression(f.read(6))
+
+    ext = os.path.splitext(fileName)[1][1:]
+    return ext if ext in _COMPRESSIONS else None
+
+
+def _detectCompression(magic):
+    """ Return the compression whose magic number starts the given bytes. """
+    for compression, prefix in _COMPRESSIONS.items():
+        if magic.startswith(prefix):
+            return compression
+    return None
+
+
+def _openCompressed(fileName, mode, compression, fileObj=None):
+    """ Open a compressed file in binary mode. Multi-threaded (de)compressors
+    are used when the optional packages are available.
+    Args:
+        fileObj: optional binary file object of fileName, that is used
+            instead of opening the file again.
+    """
+    source = fileName if fileObj is None else fileObj
+
+    if compression == 'gz':
+        if igzip_threaded is not None:
+            return igzip_threaded.open(source, mode,
+                                       threads=_COMPRESSION_THREADS)
+        return gzip.open(source, mode)
+    elif compression == 'bz2':
+        return bz2.open(source, mode)
+    elif compression == 'xz':
+        return lzma.open(source, mode)
+
+    if zstandard is None:
+        raise Exception("Package 'zstandard' is required to read or write "
+                        "file: %s" % fileName)
+    cctx = zstandard.ZstdCompressor(threads=_COMPRESSION_THREADS)
+    return zstandard.open(source, mode, cctx=cctx)
+
+
+class _DecompressedReader(io.BufferedReader):
+    """ Buffered reader of a decompressed stream that also closes the
+    compressed input file, that the decompressors leave open.
+    """
+    def __init__(self, stream, inputFile):
+        io.BufferedReader.__init__(self, stream, _BUFFER_SIZE)
+        self._inputFile = inputFile
+
+    def close(self):
+        try:
+            io.BufferedReader.close(self)
+        finally:
+            self._inputFile.close()
+
+
+def _openFile(fileName, mode='r'):
+    """ Open a file like the builtin open function, but reading and writing
+    compressed files transparently. Binary files are opened with a big
+    buffer that allows to peek many lines at once.
+    When reading, the file is opened only once and the compression is
+    detected by peeking its first bytes, so pipes can be read too.
+    """
+    binary = 'b' in mode
+    mode = mode.replace('b', '')
+
+    if mode == 'r':
+        f = open(fileName, 'rb', _BUFFER_SIZE)
+        compression = _detectCompression(f.peek(6)[:6])
+        if compression is not None:
+            try:
+                f = _DecompressedReader(
+                    _openCompressed(fileName, 'rb', compression, f), f)
+            except BaseException:
+                f.close()
+                raise
+        return f if binary else io.TextIOWrapper(f)
+
+    compression = _getCompression(fileName, mode)
+
+    if compression is None:
+        return open(fileName, mode + 'b', _BUFFER_SIZE) if binary else open(
+            fileName, mode)
+
+    f = _openCompressed(fileName, mode + 'b', compression)
+    return f if binary else io.TextIOWrapper(f)
+
+
+def _packColumns(columns, rows):
+    """ Pack the values of the rows column-wise.
+    Returns:
+        A list with a (code, bytes) pair for each column, where code
+        describes how the values were packed.
+    """
+    if not rows:
+        return [('p', pickle.dumps([])) for _ in columns]
+    return [_packColumn(list(values), col.getType())
+            for col, values in zip(columns, zip(*rows))]
+
+
+def _packColumn(values, colType):
+    """ Pack the values of a column into bytes. Numbers are stored as
+    native arrays and strings joined by nulls, only if all values are of
+    the column type. Otherwise the values are just pickled.
+    """
+    if set(map(type, values)) == {colType}:
+        try:
+            if colType is int:
+                return 'q', array('q', values).tobytes()
+            elif colType is float:
+                return 'd', array('d', values).tobytes()
+            elif colType is str:
+                data = '\0'.join(values)
+                if data.count('\0') == len(values) - 1:
+                    return 's', data.encode('utf-8', 'surrogatepass')
+        except OverflowError:
+            pass  # Too big integers
+
+    return 'p', pickle.dumps(values, pickle.HIGHEST_PROTOCOL)
+
+
+def _unpackColumn(code, data):
+    """ Return the list of values of a column packed with _packColumn. """
+    if code == 's':
+        return bytes(data).decode('utf-8', 'surrogatepass').split('\0')
+    elif code == 'p':
+        return pickle.loads(data)
+
+    values = array(code)
+    values.frombytes(data)
+    return values.tolist()
+
+
+def _createTable(columns, values, frozen=False):
+    """ Create a new table from the columns and the list of values of
+    each column.
+    """
+    if not columns:
+        return Table()
+
+    table = Table(columns=columns)
+    # The values are zipped, so there is no need to check the rows length
+    rows = map(functools.partial(tuple.__new__, table.Row), zip(*values))
+    with _bulkAllocation():
+        table._rows = tuple(rows) if frozen else list(rows)
+    table._frozen = frozen
+    return table
+
+
+@contextlib.contextmanager
+def _bulkAllocation():
+    """ Disable the garbage collector while creating many rows at once.
+    Rows can not create reference cycles, but allocating many of them
+    triggers collections that scan again all the rows created before.
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def _unpickleTable(columns, buffers, frozen):
+    return _createTable(columns, [_unpackColumn(*b) for b in buffers], frozen)
+
+
+def _unpickleRow(colNames, values):
+    return _getRowClass(colNames)._make(values)
+
+
+def _attachSharedMemory(name):
+    """ Attach to an existing shared memory block. The block is not
+    registered in the resource tracker of this process, otherwise it would
+    be released when the process finishes.
+    Before Python 3.13 attaching always registers the block, so it is
+    unregistered only if that started a new tracker for this process.
+    Processes started by multiprocessing (with fork, spawn or forkserver)
+    share the tracker of their parent, where the block is registered only
+    once by its creator, and unregistering it would break that.
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:  # Python < 3.13
+        ownTracker = resource_tracker._resource_tracker._fd is None
+        shm = shared_memory.SharedMemory(name=name)
+        if ownTracker:
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+
+def _getDtype(colType, dtype=None):
+    """ Return the NumPy dtype for a column type, if dtype is not given. """
+    if dtype is None:
+        dtype = {int: np.int64, float: np.float64}.get(colType, object)
+    return np.dtype(dtype)
+
+
+# Key of the Arrow schema metadata with the name of the star table
+_ARROW_TABLE_NAME = 'emtable.tableName'
+# Arrow types of the numeric columns
+_ARROW_TYPES = {int: 'int64', float: 'float64'}
+
+
+def _importOptional(moduleName):
+    """ Import an optional package when it is needed, since packages as
+    pandas are slow to import and most of the times they are not used.
+    """
+    try:
+        return importlib.import_module(moduleName)
+    except ImportError:
+        raise Exception("Package '%s' is required for this operation."
+                        % moduleName)
+
+
+def _getColumnType(dtype):
+    """ Return the column type for values of a NumPy dtype. """
+    return {'b': int, 'i': int, 'u': int, 'f': float}.get(dtype.kind, str)
+
+
+def _toArray(values, colType):
+    """ Convert a list of values of the given column type to a NumPy array. """
+    return _valuesArray(values, _getDtype(colType))
+
+
+def _rangeSlice(r):
+    """ Return the slice that selects the items of a range of indexes. """
+    if not r:  # e.g. range(-1, -1, -1) would select all items
+        return slice(0, 0)
+    # A negative stop of a reversed range means up to the first item
+    return slice(r.start, r.stop if r.stop >= 0 else None, r.step)
+
+
+def _columnArray(rows, index, colType, dtype=None):
+    """ Create a NumPy array with the values of the rows at index. """
+    dtype = _getDtype(colType, dtype)
+    values = map(itemgetter(index), rows)
+
+    if dtype.kind in 'biufc':  # numbers can be filled without a list
+        return np.fromiter(values, dtype=dtype, count=len(rows))
+    return _valuesArray(list(values), dtype)
+
+
+def _valuesArray(values, dtype):
+    """ Create a NumPy array with a list of values. Values of object
+    arrays are assigned one by one, so tuples (e.g. ImageLocation) are
+    not converted into another dimension of the array.
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind != 'O':
+        return np.array(values, dtype=dtype)
+
+    result = np.empty(len(values), dtype=dtype)
+    for i, v in enumerate(values):
+        result[i] = v
+    return result
+
+
+def _formatValue(v):
+    return '%0.6f' % v if isinstance(v, float) else str(v)
+
+
+def _getFormatStr(v):
+    return '.6f' if isinstance(v, float) else ''
+
+
+# --------- Command line helper functions  ------------------------
+
+def _filterTable(table, columns=None, where=None, limit=0):
+    """ Filter the rows and columns of a table in place.
+    Args:
+        columns: list of column names to keep, the others are removed
+            (ignored if the table does not have any of these columns).
+        where: python expression using the column names, only the rows
+            where it is True are kept (e.g. 'rlnClassNumber == 3'). It is
+            ignored if the table does not have any of the names used.
+        limit: if greater than 0, keep only this number of rows.
+    """
+    rows = table
+
+    if where and table.hasAnyColumn(compile(where, '<where>',
+                                            'eval').co_names):
+        func = eval('lambda %s: %s' % (', '.join(table.getColumnNames()),
+                                       where))
+        rows = [row for row in table if func(*row)]
+
+    if limit > 0:
+        rows = rows[:limit]
+
+    if rows is not table:
+        rows = list(rows)
+        table.clearRows()
+        table.extend(rows)
+
+    if columns and table.hasAnyColumn(columns):
+        table.removeColumns([c for c in table.getColumnNames()
+                             if c not in columns])
+
+
+def _convertFile(task):
+    """ Read, filter and write again all tables of a star file.
+    This is the worker function of the batch mode.
+    Returns:
+        A tuple (inputFile, numberOfRows, errorMessage).
+    """
+    inputFile, outputFile, tableName, columns, where, limit = task
+
+    try:
+        infos = Table.probe(inputFile)
+        tables = []
+
+        for name, info in infos.items():
+            table = Table(fileName=inputFile, tableName=name)
+            if tableName is None or name == tableName:
+                _filterTable(table, columns, where, limit)
+            tables.append((name, table, info.isSingleRow()))
+
+        outputDir = os.path.dirname(outputFile)
+        if outputDir and not os.path.exists(outputDir):
+            os.makedirs(outputDir, exist_ok=True)
+
+        # Write to a temporary file first, so incomplete outputs are
+        # never considered up to date
+        tmpFile = '%s.tmp%s' % os.path.splitext(outputFile)
+        with _openFile(tmpFile, 'w') as f:
+            for name, table, singleRow in tables:
+                table.writeStar(f, tableName=name, singleRow=singleRow)
+        os.replace(tmpFile, outputFile)
+
+        return inputFile, sum(len(t) for _, t, _ in tables), None
+    except Exception as e:
+        return inputFile, 0, '%s: %s' % (type(e).__name__, e)
+
+
+def _findStarFiles(inputs, ext=None):
+    """ Return (inputFile, relativeOutput) pairs from a list of
+    filenames, glob patterns or directories (searched recursively).
+    The outputs of glob matches are relative to the directory of the
+    pattern before any wildcard. An exception is raised if two inputs
+    would be written to the same output.
+    Args:
+        ext: if given, the star extension of the outputs (including the
+            compression one, e.g. '.star.gz') is replaced by this one.
+    """
+    files = OrderedDict()
+    outputs = {}
+
+    def _add(path, relPath):
+        if ext is not None:
+            relPath = _replaceStarExtension(relPath, ext)
+        other = outputs.setdefault(os.path.normpath(relPath), path)
+        if other != path:
+            raise Exception("Input files '%s' and '%s' would be written to "
+                            "the same output: %s" % (other, path, relPath))
+        files[path] = relPath
+
+    for inputPath in inputs:
+        if os.path.isdir(inputPath):
+            for root, dirs, fileNames in os.walk(inputPath):
+                for fn in sorted(fileNames):
+                    if _isStarFile(fn):
+                        path = os.path.join(root, fn)
+                        _add(path, os.path.relpath(path, inputPath))
+        else:
+            root = _globRoot(inputPath)
+            for path in sorted(glob.glob(inputPath, recursive=True)):
+                _add(path, os.path.relpath(path, root))
+
+    return list(files.items())
+
+
+def _replaceStarExtension(fileName, ext):
+    """ Replace the extension of a star file (e.g. '.star' or '.star.gz')
+    by another one. If it is not a star file, the extension is added.
+    """
+    if not _isStarFile(fileName):
+        return fileName + ext
+    root, oldExt = os.path.splitext(fileName)
+    if oldExt != '.star':  # Compression extension
+        root = os.path.splitext(root)[0]
+    return root + ext
+
+
+def _globRoot(pattern):
+    """ Return the directory of a glob pattern before the first wildcard,
+    or the directory of the file if there are no wildcards.
+    """
+    parts = []
+
+    for part in os.path.dirname(pattern).split(os.sep):
+        if glob.has_magic(part):
+            break
+        parts.append(part)
+
+    return os.sep.join(parts) or ('/' if pattern.startswith(os.sep) else '.')
+
+
+def _batchConvert(inputs, outputDir, tableName=None, columns=None,
+                  where=None, limit=0, jobs=1, force=False, ext=None):
+    """ Convert many star files using a pool of processes and print
+    a report with the throughput and the errors.
+    The outputs are compressed according to their extension, that can
+    be changed with ext (e.g. '.star.gz' or '.star' to decompress).
+    Returns:
+        The number of files that failed.
+    """
+    tasks = []
+    skipped = 0
+
+    for inputFile, relPath in _findStarFiles(inputs, ext):
+        outputFile = os.path.join(outputDir, relPath)
+        if (not force and os.path.exists(outputFile) and
+                os.path.getmtime(outputFile) >= os.path.getmtime(inputFile)):
+            skipped += 1
+        else:
+            tasks.append((inputFile, outputFile, tableName, columns, where,
+                          limit))
+
+    done = rows = 0
+    errors = []
+    t0 = time.time()
+
+    if jobs > 1 and len(tasks) > 1:
+        executor = ProcessPoolExecutor(jobs)
+        results = executor.map(_convertFile, tasks, chunksize=16)
+    else:
+        executor = None
+        results = map(_convertFile, tasks)
+
+    for inputFile, n, error in results:
+        if error:
+            errors.append(inputFile)
+            sys.stderr.write("ERROR: %s: %s\n" % (inputFile, error))
+        else:
+            done += 1
+            rows += n
+
+    if executor is not None:
+        executor.shutdown()
+
+    elapsed = max(time.time() - t0, 1e-6)
+    print("Processed %d files (%d rows) in %0.2f seconds: "
+          "%0.1f files/s, %0.1f rows/s"
+          % (done, rows, elapsed, done / elapsed, rows / elapsed))
+    print("Skipped (up to date): %d, failed: %d" % (skipped, len(errors)))
+
+    return len(errors)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description="Script to manipulate metadata files.")
+
+    add = parser.add_argument  # shortcut
+    add("input", help="Input metadata filename. ", nargs='?', default="")
+    add("output",
+        help="Output metadata filename, if no provided, print to stdout. ",
+        nargs='?', default="")
+
+    add("-l", "--limit", type=int, default=0,
+        help="Limit the number of rows processed, useful for testing. ")
+    add("-c", "--columns", default="",
+        help="Comma separated list of the columns to keep. ")
+    add("-w", "--where", default="",
+        help="Python expression with column names to filter rows, "
+             "e.g. 'rlnClassNumber == 3'. ")
+
+    # Batch mode options
+    add("-b", "--batch", nargs='+', metavar='PATH', default=[],
+        help="Process many files in parallel. Provide glob patterns or "
+             "directories (searched recursively for *.star files, that "
+             "can also be compressed). ")
+    add("-o", "--output_dir", default="",
+        help="Output directory for the batch mode. ")
+    add("-t", "--table", default=None,
+        help="In batch mode, only filter this table, others are copied. ")
+    add("-j", "--jobs", type=int, default=os.cpu_count() or 1,
+        help="Number of processes used in batch mode. ")
+    add("-f", "--force", action='store_true',
+        help="In batch mode, process files even if outputs are up to date. ")
+    add("-e", "--ext", default=None,
+        help="In batch mode, extension of the output files, e.g. "
+             ".star.gz to compress them or .star to decompress them. ")
+
+    args = parser.parse_args()
+    columns = [c for c in args.columns.split(',') if c]
+
+    if args.batch:
+        if not args.output_dir:
+            raise Exception("Output directory (--output_dir) is required "
+                            "in batch mode. ")
+        sys.exit(_batchConvert(args.batch, args.output_dir, args.table,
+                               columns, args.where, args.limit, args.jobs,
+                               args.force, args.ext) > 0)
+
+    if '@' in args.input:
+        tableName, fileName = args.input.split('@')
+    else:
+        tableName, fileName = None, args.input
+
+    if not os.path.exists(fileName):
+        raise Exception("Input file '%s' does not exists. " % fileName)
 
-        tableOut.addRow(*row)
+    table = Table(fileName=fileName, tableName=tableName)
+    _filterTable(table, columns, args.where, args.limit)
 
     if args.output:
-        tableOut.write(args.output, tableName)
+        table.write(args.output, tableName)
     else:
-        tableOut.printStar(tableName)
+        table.printStar(tableName)
@@ -25,14 +25,25 @@
 import sys
 import os
 import psutil
+import tempfile
+import shutil
+import asyncio
+import pickle
+import threading
+import subprocess
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 
 try:
     from StringIO import StringIO  # for Python 2
 except ImportError:
     from io import StringIO  # for Python 3
+from io import BytesIO
 import unittest
 
-from emtable import Table
+from emtable import (Table, ParseError, Stats, CancelToken, Cancelled,
+                     ImageLocation)
 from strings_star_relion import *
 
 here = os.path.abspath(os.path.dirname(__file__))
@@ -59,6 +70,12 @@ class TestTable(unittest.TestCase):
         for colName, col in zip(columnNames, table.getColumns()):
             self.assertEqual(colName, col.getName())
 
+    def _createTmpDir(self):
+        """ Create a temporary directory removed at the end of the test. """
+        tmpDir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpDir.cleanup)
+        return tmpDir.name
+
     def test_read_particles(self):
         """
         Read from a particles .star file
@@ -373,6 +390,1038 @@ class TestTable(unittest.TestCase):
         goldValues.update(types)
         _checkCols(goldValues, t)
 
+    def test_probe(self):
+        print("Checking probe...")
+        dataFile = testfile('star', 'refine3d', 'run_it016_half1_model.star')
+        infos = Table.probe(dataFile)
+
+        self.assertEqual(29, len(infos))
+        for tableName, info in infos.items():
+            table = Table(fileName=dataFile, tableName=tableName)
+            self.assertEqual(len(table), info.size())
+            for c1, c2 in zip(table.getColumns(), info.getColumns()):
+                self.assertEqual(c1, c2)
+
+        infos = Table.probe(BytesIO(one_micrograph_mc.encode()))
+        self.assertEqual(['general', 'global_shift', 'local_motion_model',
+                          'hot_pixels', 'local_shift'], list(infos.keys()))
+        self.assertTrue(infos['general'].isSingleRow())
+        self.assertEqual(1, infos['general'].size())
+        self.assertEqual(24, infos['global_shift'].size())
+        self.assertEqual(36, infos['local_motion_model'].size())
+
+    def test_iterChunks(self):
+        print("Checking iterChunks...")
+        dataFile = testfile('star', 'refine3d', 'run_it016_data.star')
+        table = Table(fileName=dataFile, tableName='particles')
+        colNames = table.getColumnNames()
+
+        chunks = list(Table.iterChunks(dataFile, tableName='particles',
+                                       chunkSize=7))
+        self.assertEqual(len(table), sum(len(c['rlnImageName'])
+                                         for c in chunks))
+        self.assertTrue(all(len(c['rlnImageName']) == 7 for c in chunks[:-1]))
+
+        for colName in colNames:
+            values = []
+            for chunk in chunks:
+                self.assertEqual(colNames, list(chunk.keys()))
+                values.extend(chunk[colName])
+            self.assertEqual(table.getColumnValues(colName), values)
+
+        chunks = list(Table.iterChunks('optics@' + dataFile, asArrays=True))
+        self.assertEqual(1, len(chunks))
+        self.assertEqual([1], chunks[0]['rlnOpticsGroup'].tolist())
+
+    def test_splitBy(self):
+        print("Checking splitBy...")
+        dataFile = testfile('star', 'refine3d', 'run_it016_data.star')
+        table = Table(fileName=dataFile, tableName='particles')
+        optics = Table(fileName=dataFile, tableName='optics')
+        pattern = os.path.join(self._createTmpDir(), 'subset{:02d}.star')
+
+        for processes in [1, 2]:
+            outputs = Table.splitBy('particles@' + dataFile, 'rlnRandomSubset',
+                                    pattern, processes=processes)
+            self.assertEqual({1, 2}, set(outputs.keys()))
+
+            rows = []
+            for subset, fileName in outputs.items():
+                self.assertEqual(pattern.format(subset), fileName)
+                self.assertEqual(list(optics),
+                                 list(Table(fileName=fileName,
+                                            tableName='optics')))
+                t = Table(fileName=fileName, tableName='particles')
+                self.assertTrue(all(r.rlnRandomSubset == subset for r in t))
+                rows.extend(t)
+
+            self.assertEqual(len(table), len(rows))
+            self.assertEqual(sorted(table), sorted(rows))
+
+        # Without a table name the first one (optics) is split
+        pattern = os.path.join(self._createTmpDir(), 'group{}.star')
+        for processes in [1, 2]:
+            outputs = Table.splitBy(dataFile, 'rlnOpticsGroup', pattern,
+                                    processes=processes)
+            infos = Table.probe(outputs[1])
+            self.assertEqual(['particles', 'optics'], list(infos))
+            self.assertEqual([len(table), 1],
+                             [len(info) for info in infos.values()])
+
+    def test_batchConvert(self):
+        print("Checking batch conversion...")
+        from emtable.metadata import _batchConvert
+        inputDir = testfile('star', 'refine3d')
+        outputDir = self._createTmpDir()
+
+        errors = _batchConvert([inputDir], outputDir, tableName='particles',
+                               columns=['rlnImageName', 'rlnRandomSubset'],
+                               where='rlnRandomSubset == 2', jobs=2)
+        self.assertEqual(0, errors)
+        self.assertEqual(sorted(os.listdir(inputDir)),
+                         sorted(os.listdir(outputDir)))
+
+        outputFile = os.path.join(outputDir, 'run_it016_data.star')
+        table = Table(fileName=outputFile, tableName='particles')
+        self.assertEqual(['rlnImageName', 'rlnRandomSubset'],
+                         table.getColumnNames())
+        self.assertTrue(len(table) > 0)
+        self.assertTrue(all(r.rlnRandomSubset == 2 for r in table))
+        self.assertEqual(1, len(Table(fileName=outputFile, tableName='optics')))
+
+        # Outputs are up to date now, so they should not be written again
+        mtime = os.path.getmtime(outputFile)
+        _batchConvert([inputDir], outputDir, jobs=2)
+        self.assertEqual(mtime, os.path.getmtime(outputFile))
+
+        # Glob outputs keep the path after the wildcards, and rows are
+        # only filtered in the tables with the columns used in where
+        tmpDir = self._createTmpDir()
+        dataFile = os.path.join(inputDir, 'run_it016_data.star')
+        for job in ['job1', 'job2']:
+            os.makedirs(os.path.join(tmpDir, job))
+            shutil.copy(dataFile, os.path.join(tmpDir, job, 'data.star'))
+
+        errors = _batchConvert([os.path.join(tmpDir, '*', 'data.star')],
+                               outputDir, where='rlnRandomSubset == 2')
+        self.assertEqual(0, errors)
+        for job in ['job1', 'job2']:
+            outputFile = os.path.join(outputDir, job, 'data.star')
+            self.assertEqual(1, len(Table(fileName=outputFile,
+                                          tableName='optics')))
+            table = Table(fileName=outputFile, tableName='particles')
+            self.assertTrue(len(table) > 0)
+            self.assertTrue(all(r.rlnRandomSubset == 2 for r in table))
+
+        # Compress the outputs changing their extension
+        errors = _batchConvert([tmpDir], outputDir, ext='.star.gz')
+        self.assertEqual(0, errors)
+        outputFile = os.path.join(outputDir, 'job1', 'data.star.gz')
+        with open(outputFile, 'rb') as f:
+            self.assertEqual(b'\x1f\x8b', f.read(2))
+        self.assertEqual(len(Table(fileName=dataFile, tableName='particles')),
+                         len(Table(fileName=outputFile,
+                                   tableName='particles')))
+
+        with self.assertRaises(Exception):
+            _batchConvert([os.path.join(tmpDir, 'job1', 'data.star'),
+                           os.path.join(tmpDir, 'job2', 'data.star')],
+                          outputDir)
+
+    def test_concat(self):
+        print("Checking concat...")
+        dataFile = testfile('star', 'refine3d', 'run_it016_data.star')
+        table = Table(fileName=dataFile, tableName='particles')
+        tmpDir = self._createTmpDir()
+        outputs = Table.splitBy('particles@' + dataFile, 'rlnRandomSubset',
+                                os.path.join(tmpDir, 'subset{}.star'))
+        inputFiles = list(outputs.values())
+
+        # Copy rows straight to the output file
+        outputFile = os.path.join(tmpDir, 'all.star')
+        Table.concat(inputFiles, outputFile, tableName='particles')
+        t = Table(fileName=outputFile, tableName='particles')
+        self.assertEqual(sorted(table), sorted(t))
+        self.assertEqual(1, len(Table(fileName=outputFile, tableName='optics')))
+
+        # Merge inputs sorted by a given column
+        for fn in inputFiles:
+            t = Table(fileName=fn, tableName='particles')
+            t.sort('rlnImageName')
+            t.write(fn, tableName='particles')
+
+        t = Table.concat(inputFiles, tableName='particles', key='rlnImageName')
+        self.assertEqual(sorted(table.getColumnValues('rlnImageName')),
+                         t.getColumnValues('rlnImageName'))
+
+        # Inputs with different types of the same columns
+        mixedDir = self._createTmpDir()
+        mixedFiles = [os.path.join(mixedDir, 'mixed%d.star' % i)
+                      for i in range(3)]
+        # (the last column is only promoted after the first rows)
+        values = [['1 a 1', '2 b 1'], ['1.5 c 2', '3.25 d 2'],
+                  ['%d e 3' % i for i in range(4, 200)] + ['250.5 f 3.5']]
+        for fn, lines in zip(mixedFiles, values):
+            with open(fn, 'w') as f:
+                f.write('data_values\nloop_\n_x\n_name\n_n\n%s\n'
+                        % '\n'.join(lines))
+        xs = [float(line.split()[0]) for lines in values for line in lines]
+        ns = [float(line.split()[2]) for lines in values for line in lines]
+
+        t = Table.concat(mixedFiles)
+        self.assertEqual([float, str, float],
+                         [c.getType() for c in t.getColumns()])
+        self.assertEqual(xs, t.getColumnValues('x'))
+        self.assertEqual(ns, t.getColumnValues('n'))
+        self.assertTrue(all(type(n) is float for n in t.getColumnValues('n')))
+        t = Table.concat(mixedFiles, key='x')
+        self.assertEqual(sorted(xs), t.getColumnValues('x'))
+        outputFile = os.path.join(mixedDir, 'all.star')
+        Table.concat(mixedFiles, outputFile, key='x')
+        t = Table(fileName=outputFile)
+        self.assertEqual(float, t.getColumn('x').getType())
+        self.assertEqual(sorted(xs), t.getColumnValues('x'))
+
+        # A column promoted to str after the rows are written to the output
+        strFiles = mixedFiles[:2]
+        with open(strFiles[0], 'w') as f:
+            f.write('data_values\nloop_\n_a\n%s\nabc\n'
+                    % '\n'.join(['1.5'] * 150))
+        with open(strFiles[1], 'w') as f:
+            f.write('data_values\nloop_\n_a\n0.25\n2.75\n')
+        Table.concat(strFiles, outputFile, key='a')
+        t = Table(fileName=outputFile)
+        self.assertEqual(str, t.getColumn('a').getType())
+        self.assertEqual(sorted(['1.5'] * 150 + ['abc', '0.25', '2.75']),
+                         t.getColumnValues('a'))
+
+        # Columns should be the same in all inputs
+        t.removeColumns('rlnRandomSubset')
+        t.write(inputFiles[0], tableName='particles')
+        with self.assertRaises(Exception):
+            Table.concat(inputFiles, tableName='particles')
+
+    def test_compressed(self):
+        print("Checking compressed files...")
+        dataFile = testfile('star', 'refine3d', 'run_it016_data.star')
+        table = Table(fileName=dataFile, tableName='particles')
+        tmpDir = self._createTmpDir()
+
+        for ext in ['gz', 'bz2', 'xz']:
+            fn = os.path.join(tmpDir, 'particles.star.' + ext)
+            table.write(fn, tableName='particles')
+            # Compression is detected from the content when reading
+            compressedFile = os.path.join(tmpDir, 'particles_%s.star' % ext)
+            os.rename(fn, compressedFile)
+
+            self.assertEqual(list(table),
+                             list(Table(fileName=compressedFile,
+                                        tableName='particles')))
+            self.assertEqual(list(table),
+                             list(Table.iterRows('particles@' + compressedFile)))
+            self.assertEqual(len(table),
+                             Table.probe(compressedFile)['particles'].size())
+
+            # Pipes can only be opened once, the same stream is decompressed
+            if os.path.isdir('/dev/fd'):
+                with open(compressedFile, 'rb') as f:
+                    data = f.read()
+                for read in [lambda fn: list(Table(fileName=fn,
+                                                   tableName='particles')),
+                             lambda fn: list(Table.iterRows('particles@' + fn))]:
+                    readFd, writeFd = os.pipe()
+                    writer = threading.Thread(target=self._writePipe,
+                                              args=(writeFd, data))
+                    writer.start()
+                    try:
+                        self.assertEqual(list(table),
+                                         read('/dev/fd/%d' % readFd))
+                    finally:
+                        os.close(readFd)
+                        writer.join()
+
+    @staticmethod
+    def _writePipe(fd, data):
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+        except BrokenPipeError:
+            pass
+
+    def test_async(self):
+        print("Checking async read and write...")
+        dataFile = testfile('star', 'refine3d', 'run_it016_data.star')
+        table = Table(fileName=dataFile, tableName='particles')
+        outputFile = os.path.join(self._createTmpDir(), 'particles.star')
+
+        async def _readAll():
+            tables = await asyncio.gather(*[
+                Table().aread(dataFile, tableName='particles')
+                for _ in range(4)])
+            rows = [row async for row in Table.aiterRows(
+                'particles@' + dataFile, chunkSize=100)]
+            sortedRows = [row async for row in Table.aiterRows(
+                'particles@' + dataFile, key='rlnDefocusU')]
+            await tables[0].awrite(outputFile, tableName='particles')
+            return tables, rows, sortedRows
+
+        tables, rows, sortedRows = asyncio.run(_readAll())
+
+        for t in tables:
+            self.assertEqual(list(table), list(t))
+        self.assertEqual(list(table), rows)
+        self.assertEqual(sorted(table, key=lambda r: r.rlnDefocusU),
+                         sortedRows)
+        self.assertEqual(list(table), list(Table(fileName=outputFile,
+                                                 tableName='particles')))
+
+    def test_freeze(self):
+        print("Checking freeze and share...")
+        dataFile = testfile('star', 'refine3d', 'run_it016_data.star')
+        table = Table(fileName=dataFile, tableName='particles')
+        rows = list(table)
+        frozen = table.freeze()
+
+        self.assertTrue(frozen.isFrozen())
+        self.assertFalse(table.isFrozen())
+        self.assertEqual(rows, list(frozen))
+
+        for func, args in [(frozen.addRow, rows[0]),
+                           (frozen.removeColumns, ['rlnClassNumber']),
+                           (frozen.addColumns, ['rlnNewColumn=0']),
+                           (frozen.sort, ['rlnDefocusU']),
+                           (frozen.clearRows, []),
+                           (frozen.__setitem__, [0, rows[1]])]:
+            with self.assertRaises(Exception):
+                func(*args)
+
+        # Changes in the original table do not affect the snapshot
+        table.removeColumns('rlnClassNumber')
+        table.clearRows()
+        self.assertEqual(rows, list(frozen))
+        self.assertTrue(frozen.hasColumn('rlnClassNumber'))
+
+        shared = frozen.share()
+        try:
+            with ProcessPoolExecutor(2) as executor:
+                sums = list(executor.map(_sumColumn, [shared] * 2,
+                                         ['rlnDefocusU', 'rlnImageName']))
+                self.assertEqual(sum(r.rlnDefocusU for r in rows), sums[0])
+                self.assertEqual(len(rows), sums[1])
+                t = executor.submit(_getSharedTable, shared).result()
+                self.assertEqual(rows, list(t))
+            # Spawned workers share the resource tracker too
+            context = multiprocessing.get_context('spawn')
+            with ProcessPoolExecutor(1, mp_context=context) as executor:
+                t = executor.submit(_getSharedTable, shared).result()
+                self.assertEqual(rows, list(t))
+            # Unrelated processes do not release the blocks when finishing
+            env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+            script = ('import sys, pickle; '
+                      'print(len(pickle.load(sys.stdin.buffer).getTable()))')
+            output = subprocess.run([sys.executable, '-c', script],
+                                    input=pickle.dumps(shared), env=env,
+                                    stdout=subprocess.PIPE, check=True).stdout
+            self.assertEqual(len(rows), int(output))
+            self.assertEqual(rows, list(_getSharedTable(shared)))
+        finally:
+            shared.unlink()
+
+    def test_pickle(self):
+        print("Checking pickle...")
+        dataFile = testfile('star', 'refine3d', 'run_it016_data.star')
+        table = Table(fileName=dataFile, tableName='particles')
+        # Values with a type different from the column type are also kept
+        table.addRow(*table[0]._replace(rlnDefocusU=1, rlnClassNumber=2 ** 70))
+
+        for t in [table, table.freeze(), Table()]:
+            t2 = pickle.loads(pickle.dumps(t))
+            self.assertEqual(t.isFrozen(), t2.isFrozen())
+            self.assertEqual(list(t), list(t2))
+            self.assertEqual(list(t.getColumns()), list(t2.getColumns()))
+
+        row = pickle.loads(pickle.dumps(table[-1]))
+        self.assertEqual(table[-1], row)
+        self.assertEqual(1, row.rlnDefocusU)
+        self.assertIsInstance(row.rlnDefocusU, int)
+        self.assertEqual(table.getColumnNames(), list(row._fields))
+
+        with ProcessPoolExecutor(2) as executor:
+            self.assertEqual([len(table), len(table.getColumns())],
+                             list(executor.map(len, [table, table[0]])))
+
+    def test_rowClass(self):
+        print("Checking Row classes are shared...")
+        dataFile = testfile('star', 'refine3d', 'run_it016_data.star')
+        t1 = Table(fileName=dataFile, tableName='particles')
+        t2 = Table(fileName=dataFile, tableName='particles')
+        self.assertIs(t1.Row, t2.Row)
+
+        with open(dataFile) as f:
+            self.assertIs(t1.Row, Table.Reader(f, 'particles').Row)
+
+        t2.removeColumns('rlnClassNumber')
+        self.assertIsNot(t1.Row, t2.Row)
+        t3 = Table(columns=t2.getColumnNames())
+        self.assertIs(t2.Row, t3.Row)
+        self.assertEqual(t2.getColumnNames(), list(t3.Row._fields))
+
+    def test_parseErrors(self):
+        print("Checking parsing errors...")
+        lines = particles_3d_classify.split('\n')
+        # Set a wrong value for rlnClassNumber in one of the last rows
+        lineNo = len(lines) - 7
+        values = lines[lineNo - 1].split()
+        values[3] = 'X'
+        lines[lineNo - 1] = ' '.join(values)
+        starStr = '\n'.join(lines)
+
+        # A guessed int column would be promoted to str when errors are
+        # raised, so set its type
+        types = {'rlnClassNumber': int}
+        for readFunc in [lambda f: Table().readStar(f, types=types),
+                         lambda f: list(Table.Reader(f, types=types))]:
+            with self.assertRaises(Exception) as cm:
+                readFunc(StringIO(starStr))
+            msg = str(cm.exception)
+            self.assertIn('line %d:' % lineNo, msg)
+            self.assertIn("rlnClassNumber (int): 'X'", msg)
+            self.assertIsInstance(cm.exception, ParseError)
+            self.assertEqual(lineNo, cm.exception.lineNo)
+
+        # Skip or collect the wrong lines instead of raising an error
+        offset = len('\n'.join(lines[:lineNo - 1])) + 1
+        t = Table()
+        t.readStar(StringIO(starStr), errors='skip')
+        self.assertEqual(15, len(t))
+        self.assertEqual([], t.getErrors())
+
+        t.readStar(StringIO(starStr), errors='collect')
+        self.assertEqual(15, len(t))
+        self.assertEqual([(lineNo, offset)],
+                         [(e.lineNo, e.offset) for e in t.getErrors()])
+        self.assertEqual(values, t.getErrors()[0].values)
+
+        errors = []
+        rows = list(Table.Reader(StringIO(starStr), errors=errors))
+        self.assertEqual(list(t), rows)
+        self.assertEqual([(lineNo, offset)],
+                         [(e.lineNo, e.offset) for e in errors])
+
+    def test_stats(self):
+        print("Checking stats...")
+        dataFile = testfile('star', 'refine3d', 'run_it016_data.star')
+        stats = Stats()
+        table = Table(fileName=dataFile, tableName='particles', stats=stats)
+        n = len(table)
+        self.assertEqual(n, stats.rows)
+        self.assertGreater(stats.lines, n)
+        self.assertGreater(stats.bytes, 0)
+        self.assertEqual(0, stats.errors)
+        self.assertEqual(0, stats.shlexLines)
+        for phase in ['read', 'split', 'convert', 'rows']:
+            self.assertGreater(stats.times[phase], 0, phase)
+
+        # Values are accumulated when the stats are used again
+        rows = list(Table.iterRows('particles@' + dataFile, stats=stats))
+        self.assertEqual(list(table), rows)
+        self.assertEqual(2 * n, stats.rows)
+
+        with tempfile.TemporaryDirectory() as tmpDir:
+            outFile = os.path.join(tmpDir, 'particles.star')
+            writeStats = Stats()
+            table.write(outFile, 'particles', stats=writeStats)
+            self.assertEqual(n, writeStats.rows)
+            self.assertGreater(writeStats.times['format'], 0)
+            self.assertEqual(list(table),
+                             list(Table(fileName=outFile)))
+
+        d = stats.toDict()
+        self.assertEqual(2 * n, d['rows'])
+        self.assertAlmostEqual(stats.getTime(), d['time'])
+        self.assertEqual(stats.times['split'], d['splitTime'])
+
+    def test_progress(self):
+        print("Checking progress and cancel...")
+        dataFile = testfile('star', 'refine3d', 'run_it016_data.star')
+        calls = []
+
+        def _progress(rows, bytes, fraction):
+            calls.append((rows, bytes, fraction))
+
+        table = Table(fileName=dataFile, tableName='particles',
+                      progress=_progress)
+        self.assertTrue(calls)
+        self.assertEqual((len(table), 1.0), (calls[-1][0], calls[-1][2]))
+
+        with tempfile.TemporaryDirectory() as tmpDir:
+            outFile = os.path.join(tmpDir, 'particles.star')
+            calls = []
+            table.write(outFile, 'particles', progress=_progress)
+            self.assertEqual((len(table), 1.0), (calls[-1][0], calls[-1][2]))
+
+            cancel = CancelToken()
+            cancel.cancel()
+            with self.assertRaises(Cancelled):
+                table.write(outFile, 'particles', cancel=cancel)
+            with self.assertRaises(Cancelled):
+                list(Table.iterRows(dataFile, cancel=cancel))
+            with self.assertRaises(Cancelled):
+                Table.concat([dataFile, dataFile], outputFile=outFile,
+                             tableName='particles', key='rlnImageName',
+                             cancel=cancel)
+            rows = list(table)
+            with self.assertRaises(Cancelled):
+                table.sort('rlnDefocusU', cancel=cancel)
+            self.assertEqual(rows, list(table))
+
+            t = Table()
+            with self.assertRaises(Cancelled):
+                t.read(dataFile, 'particles', cancel=cancel)
+            self.assertEqual(0, len(t))
+
+    def test_columnArrays(self):
+        print("Checking column arrays...")
+        dataFile = testfile('star', 'refine3d', 'run_it016_data.star')
+        table = Table(fileName=dataFile, tableName='particles')
+
+        defocus = table.getColumnArray('rlnDefocusU')
+        self.assertEqual(np.float64, defocus.dtype)
+        self.assertEqual(table.getColumnValues('rlnDefocusU'),
+                         defocus.tolist())
+        self.assertEqual(np.float32,
+                         table.getColumnArray('rlnDefocusU', np.float32).dtype)
+
+        arrays = table.getColumnArrays(['rlnClassNumber', 'rlnImageName'],
+                                       dtype={'rlnImageName': str})
+        self.assertEqual(['rlnClassNumber', 'rlnImageName'], list(arrays))
+        self.assertEqual(np.int64, arrays['rlnClassNumber'].dtype)
+        self.assertEqual('U', arrays['rlnImageName'].dtype.kind)
+        self.assertEqual(table.getColumnValues('rlnImageName'),
+                         arrays['rlnImageName'].tolist())
+
+        with self.assertRaises(Exception):
+            table.getColumnArray('rlnNonExisting')
+
+        shared = table.share()
+        try:
+            values = shared.getColumnArray('rlnDefocusU')
+            self.assertTrue(np.array_equal(defocus, values))
+            self.assertFalse(values.flags.writeable)
+            names = shared.getColumnArray('rlnImageName')
+            self.assertEqual(arrays['rlnImageName'].tolist(), names.tolist())
+            del values
+        finally:
+            shared.unlink()
+
+    def test_fromColumns(self):
+        print("Checking fromColumns and extend...")
+        n = 1000
+        coords = np.arange(2 * n, dtype=np.float32).reshape((n, 2))
+        table = Table.fromColumns([
+            ('rlnCoordinateX', coords[:, 0]),
+            ('rlnCoordinateY', coords[:, 1]),
+            ('rlnClassNumber', np.arange(n) % 3),
+            ('rlnMicrographName', ['mic%03d.mrc' % (i % 10)
+                                   for i in range(n)]),
+            ('rlnAutopickFigureOfMerit', np.full(n, 0.5))
+        ], types={'rlnAutopickFigureOfMerit': str})
+
+        self.assertEqual(n, len(table))
+        self.assertEqual([float, float, int, str, str],
+                         [c.getType() for c in table.getColumns()])
+        row = table[1]
+        self.assertEqual((2.0, 3.0, 1, 'mic001.mrc', '0.5'), tuple(row))
+        self.assertIsInstance(row.rlnCoordinateX, float)
+        self.assertIsInstance(row.rlnClassNumber, int)
+
+        with self.assertRaises(Exception):
+            Table.fromColumns({'a': [1, 2], 'b': [1]})
+
+        other = Table(columns=table.getColumnNames())
+        other.extend(table)
+        other.extend([(0.0, 1.0, 2, 'mic.mrc', '1.0')])
+        self.assertEqual(n + 1, len(other))
+        self.assertEqual(list(table), list(other)[:n])
+        self.assertEqual(2, other[n].rlnClassNumber)
+
+        with self.assertRaises(TypeError):
+            other.extend([(1, 2)])
+
+        # Object arrays keep their items, that are converted if needed
+        locations = np.empty(2, dtype=object)
+        locations[:] = [ImageLocation('000001@a.mrcs'), ImageLocation('b.mrc')]
+        table = Table.fromColumns(
+            [('rlnImageName', locations),
+             ('rlnMicrographName', np.array(['2@c.mrcs', '3@c.mrcs'])),
+             ('rlnClassNumber', np.array(['1', '2'], dtype=object))],
+            types={'rlnImageName': ImageLocation,
+                   'rlnMicrographName': ImageLocation,
+                   'rlnClassNumber': int})
+        self.assertEqual([ImageLocation, ImageLocation, int],
+                         [c.getType() for c in table.getColumns()])
+        self.assertEqual((ImageLocation('a.mrcs', 1, 6),
+                          ImageLocation('c.mrcs', 2, 1), 1), tuple(table[0]))
+        self.assertEqual(ImageLocation('b.mrc'), table[1].rlnImageName)
+        self.assertEqual(['000001@a.mrcs', 'b.mrc'],
+                         Table.fromColumns({'a': locations}).getColumnValues('a'))
+
+        table = Table.fromColumns({'a': [1, 2], 'b': ['x', 'y']})
+        table.extend(np.array([[3, 4]]))
+        self.assertEqual([1, 2, 3], table.getColumnValues('a'))
+
+    def test_dataFrame(self):
+        print("Checking pandas DataFrames...")
+        try:
+            import pandas
+        except ImportError:
+            self.skipTest("pandas is not installed")
+
+        dataFile = testfile('star', 'refine3d', 'run_it016_data.star')
+        table = Table(fileName=dataFile, tableName='particles')
+        df = table.toDataFrame()
+        self.assertEqual(table.getColumnNames(), list(df.columns))
+        self.assertEqual(len(table), len(df))
+        self.assertEqual(np.float64, df['rlnDefocusU'].dtype)
+        self.assertEqual(np.int64, df['rlnClassNumber'].dtype)
+        self.assertEqual(table.getColumnValues('rlnImageName'),
+                         df['rlnImageName'].tolist())
+
+        table2 = Table.fromDataFrame(df)
+        self.assertEqual([c.getType() for c in table.getColumns()],
+                         [c.getType() for c in table2.getColumns()])
+        self.assertEqual(list(table), list(table2))
+
+        # The star output should be the same
+        out1, out2 = StringIO(), StringIO()
+        table.writeStar(out1, tableName='particles')
+        table2.writeStar(out2, tableName='particles')
+        self.assertEqual(out1.getvalue(), out2.getvalue())
+
+        # ImageLocation columns are kept as objects in the DataFrame
+        types = {'rlnImageName': ImageLocation}
+        table = Table(fileName=dataFile, tableName='particles', types=types)
+        df = table.toDataFrame()
+        self.assertIsInstance(df['rlnImageName'][0], ImageLocation)
+        table2 = Table.fromDataFrame(df, types=types)
+        self.assertEqual(ImageLocation, table2.getColumn('rlnImageName').getType())
+        self.assertEqual(list(table), list(table2))
+        table2 = Table.fromDataFrame(df)
+        self.assertEqual([str(v) for v in table.getColumnValues('rlnImageName')],
+                         table2.getColumnValues('rlnImageName'))
+
+    def test_arrow(self):
+        print("Checking Arrow and Parquet...")
+        try:
+            import pyarrow
+        except ImportError:
+            self.skipTest("pyarrow is not installed")
+
+        dataFile = testfile('star', 'refine3d', 'run_it016_data.star')
+        table = Table(fileName=dataFile, tableName='particles')
+        arrowTable = table.toArrow('particles')
+        self.assertEqual(table.getColumnNames(), arrowTable.column_names)
+        self.assertEqual(pyarrow.float64(),
+                         arrowTable.schema.field('rlnDefocusU').type)
+        self.assertEqual(pyarrow.string(),
+                         arrowTable.schema.field('rlnImageName').type)
+
+        table2 = Table.fromArrow(arrowTable)
+        self.assertEqual([c.getType() for c in table.getColumns()],
+                         [c.getType() for c in table2.getColumns()])
+        self.assertEqual(list(table), list(table2))
+
+        with tempfile.TemporaryDirectory() as tmpDir:
+            parquetFile = os.path.join(tmpDir, 'particles.parquet')
+            table.writeParquet(parquetFile, tableName='particles')
+            self.assertEqual('particles',
+                             Table.getParquetTableName(parquetFile))
+            self.assertEqual(list(table), list(Table.readParquet(parquetFile)))
+
+            columns = ['rlnImageName', 'rlnClassNumber']
+            table3 = Table.readParquet(parquetFile, columns=columns)
+            self.assertEqual(columns, table3.getColumnNames())
+            self.assertEqual(table.getColumnValues('rlnClassNumber'),
+                             table3.getColumnValues('rlnClassNumber'))
+
+    def test_intern(self):
+        print("Checking interned columns and codes...")
+        dataFile = testfile('star', 'refine3d', 'run_it016_data.star')
+        table = Table(fileName=dataFile, tableName='particles')
+        table2 = Table(fileName=dataFile, tableName='particles',
+                       intern=['rlnMicrographName'])
+        self.assertEqual(list(table), list(table2))
+
+        micNames = table2.getColumnValues('rlnMicrographName')
+        unique = {}
+        for micName in micNames:
+            self.assertIs(unique.setdefault(micName, micName), micName)
+        self.assertEqual(len(unique), len(set(map(id, micNames))))
+
+        # Only interned columns share the values
+        micNames2 = Table(fileName=dataFile, tableName='particles',
+                         intern=True).getColumnValues('rlnMicrographName')
+        self.assertEqual(len(unique), len(set(map(id, micNames2))))
+        rows = list(Table.iterRows('particles@' + dataFile,
+                                   intern=['rlnMicrographName']))
+        self.assertEqual(len(unique),
+                         len(set(id(r.rlnMicrographName) for r in rows)))
+
+        codes, values = table.getColumnCodes('rlnMicrographName')
+        self.assertEqual(list(unique), values)
+        self.assertEqual(micNames, [values[c] for c in codes])
+        self.assertEqual(np.int32, codes.dtype)
+
+    def test_imageLocation(self):
+        print("Checking image locations...")
+        dataFile = testfile('star', 'refine3d', 'run_it016_data.star')
+        table = Table(fileName=dataFile, tableName='particles')
+        types = {'rlnImageName': ImageLocation}
+        table2 = Table(fileName=dataFile, tableName='particles', types=types)
+        self.assertIs(ImageLocation, table2.getColumn('rlnImageName').getType())
+
+        paths = {}
+        for row, row2 in zip(table, table2):
+            loc = row2.rlnImageName
+            index, path = row.rlnImageName.split('@')
+            self.assertEqual((path, int(index), len(index)), loc)
+            self.assertEqual(row.rlnImageName, str(loc))
+            self.assertIs(paths.setdefault(path, loc.path), loc.path)
+
+        loc = ImageLocation('000012@stack.mrcs')
+        self.assertEqual(('stack.mrcs', 12, 6), loc)
+        self.assertEqual(loc, ImageLocation('stack.mrcs', 12, 6))
+        self.assertEqual('12@stack.mrcs', str(ImageLocation('stack.mrcs', 12)))
+        self.assertEqual(('image.mrc', None, 0), ImageLocation('image.mrc'))
+        self.assertEqual('image.mrc', str(ImageLocation('image.mrc')))
+        self.assertEqual(loc, pickle.loads(pickle.dumps(loc)))
+        self.assertLess(ImageLocation('a.mrcs', 2), ImageLocation('b.mrcs', 1))
+
+        # Written values are the same as the original ones
+        out1, out2 = StringIO(), StringIO()
+        table.writeStar(out1, tableName='particles')
+        table2.writeStar(out2, tableName='particles')
+        self.assertEqual(out1.getvalue(), out2.getvalue())
+
+        rows = list(Table.iterRows(dataFile, tableName='particles',
+                                   types=types))
+        self.assertEqual(list(table2), rows)
+
+        # Locations are single values of object arrays and data frames
+        locations = table2.getColumnValues('rlnImageName')
+        values = table2.getColumnArray('rlnImageName')
+        self.assertEqual((len(table2),), values.shape)
+        self.assertEqual(locations, values.tolist())
+        df = table2.toDataFrame()
+        self.assertEqual(locations, df['rlnImageName'].tolist())
+        compact = Table()
+        compact.read(dataFile, 'particles', types=types, precision='compact')
+        self.assertEqual(locations,
+                         compact.getColumnArray('rlnImageName').tolist())
+
+    def test_accessPlan(self):
+        print("Checking access plan...")
+        dataFile = testfile('star', 'refine3d', 'run_it016_data.star')
+        table = Table(fileName=dataFile, tableName='particles')
+        imageNames = table.getColumnValues('rlnImageName')
+        plan = table.getAccessPlan()
+        self.assertEqual(len(table), len(plan))
+        self.assertEqual(list(range(len(table))), sorted(plan.order))
+
+        locations = [ImageLocation(imageNames[i]) for i in plan.order]
+        self.assertEqual(sorted(locations), locations)
+        self.assertEqual([loc.index for loc in locations], plan.slices)
+        self.assertEqual(len(set(loc.path for loc in locations)),
+                         len(plan.groups))
+        for path, rows, slices in plan:
+            for i, s in zip(rows, slices):
+                self.assertEqual((path, s), ImageLocation(imageNames[i])[:2])
+
+        results = [imageNames[i] for i in plan.order]
+        self.assertEqual(imageNames, plan.restore(results))
+
+        shards = plan.getShards(3)
+        self.assertEqual(3, len(shards))
+        self.assertEqual(plan.order, sum((s.order for s in shards), []))
+        self.assertLessEqual(max(map(len, shards)) - min(map(len, shards)), 1)
+        for shard in shards:
+            self.assertEqual(len(shard), sum(len(r) for _, r, _ in shard))
+
+        # Same plan from parsed locations
+        table2 = Table(fileName=dataFile, tableName='particles',
+                       types={'rlnImageName': ImageLocation})
+        self.assertEqual(plan.order, table2.getAccessPlan().order)
+
+    def test_compact(self):
+        print("Checking compact tables...")
+        dataFile = testfile('star', 'refine3d', 'run_it016_data.star')
+        table = Table(fileName=dataFile, tableName='particles')
+        compact = Table(fileName=dataFile, tableName='particles',
+                        precision='compact', dtypes={'rlnDefocusU': 'float64'})
+        self.assertTrue(compact.isFrozen())
+        self.assertEqual(len(table), len(compact))
+        self.assertEqual(table.getColumnNames(), compact.getColumnNames())
+        self.assertEqual(table.getColumnValues('rlnDefocusU'),
+                         compact.getColumnValues('rlnDefocusU'))
+        self.assertEqual(table.getColumnValues('rlnImageName'),
+                         compact.getColumnValues('rlnImageName'))
+        self.assertEqual(table[-1].rlnClassNumber, compact[-1].rlnClassNumber)
+        self.assertEqual([r.rlnImageName for r in table[:10]],
+                         [r.rlnImageName for r in compact[:10]])
+        self.assertEqual(len(table), len(list(compact)))
+
+        values = compact.getColumnArray('rlnAnglePsi')
+        self.assertEqual(np.float32, values.dtype)
+        self.assertTrue(np.allclose(table.getColumnArray('rlnAnglePsi'),
+                                    values, atol=1e-4))
+        self.assertEqual(np.float64,
+                         compact.getColumnArray('rlnAnglePsi', float).dtype)
+
+        with self.assertRaises(Exception):
+            compact.addRow(*table[0])
+        with self.assertRaises(Exception):
+            compact.sort('rlnDefocusU')
+        self.assertIs(compact._rows, compact.freeze()._rows)
+
+        # Other tables can be read into the same table
+        other = Table()
+        other.read(dataFile, 'particles', precision='compact')
+        other.read(dataFile, 'optics')
+        self.assertFalse(other.isFrozen())
+        self.assertEqual(1, len(other))
+        other.read(dataFile, 'particles', precision='compact')
+        self.assertEqual(len(table), len(other))
+
+        # Written values are the same within the precision of float32
+        output = StringIO()
+        compact.writeStar(output, tableName='particles')
+        output.seek(0)
+        table2 = Table()
+        table2.readStar(output, 'particles')
+        for colName in ['rlnCoordinateX', 'rlnCtfFigureOfMerit']:
+            self.assertTrue(np.allclose(table.getColumnArray(colName),
+                                        table2.getColumnArray(colName),
+                                        rtol=1e-6))
+
+        # Integer columns use bigger types when needed
+        starStr = 'data_\nloop_\n_rlnSmall\n_rlnBig\n%s\n' % '\n'.join(
+            '%d %d' % (i % 3, i * 1000) for i in range(20000))
+        table = Table()
+        table.readStar(StringIO(starStr), precision='compact')
+        self.assertEqual(['b', 'i'],
+                         [c.typecode for c in table._rows._columns])
+        self.assertEqual(19999000, table[-1].rlnBig)
+
+        with self.assertRaises(Exception):
+            table.readStar(StringIO(starStr), dtypes={'rlnBig': 'bool'})
+        table.readStar(StringIO(starStr), dtypes={'rlnBig': 'float32'})
+        self.assertEqual('f', table._rows._columns[1].typecode)
+
+        # The dtypes should fit the type of the columns
+        for colName, dtype in [('rlnImageName', 'float32'),
+                               ('rlnDefocusU', 'int32')]:
+            with self.assertRaisesRegex(Exception, 'Invalid dtype.*' + colName):
+                Table(fileName=dataFile, tableName='particles',
+                      dtypes={colName: dtype})
+        starStr += '1 2.5\n'  # rlnBig is promoted to float at the end
+        table.readStar(StringIO(starStr), dtypes={'rlnBig': 'float32'})
+        self.assertEqual('f', table._rows._columns[1].typecode)
+        self.assertEqual(2.5, table[-1].rlnBig)
+        with self.assertRaisesRegex(Exception, 'Invalid dtype.*rlnBig'):
+            table.readStar(StringIO(starStr), dtypes={'rlnBig': 'int64'})
+
+    def test_typeInference(self):
+        print("Checking type inference...")
+        lines = ['data_values', 'loop_', '_id', '_x', '_label']
+        lines += ['%d %d %d' % (i, i, i) for i in range(150)]
+        lines += ['150 1.5 1', '151 2 A', '152 3 3']
+        starStr = '\n'.join(lines) + '\n'
+
+        for kwargs in [{}, {'guessRows': 1}, {'guessRows': 1000},
+                       {'precision': 'compact'}]:
+            t = Table()
+            t.readStar(StringIO(starStr), **kwargs)
+            self.assertEqual([int, float, str],
+                             [c.getType() for c in t.getColumns()])
+            self.assertEqual(153, len(t))
+            self.assertEqual((0, 0.0, '0'), tuple(t[0]))
+            self.assertEqual((150, 1.5, '1'), tuple(t[150]))
+            self.assertEqual((151, 2.0, 'A'), tuple(t[151]))
+
+        # Values read before a promotion to str keep their text
+        text = starStr.replace('\n0 0 0\n', '\n0 0 007\n')
+        text = text.replace('\n1 1 1\n', '\n1 1 1e3\n')
+        for kwargs in [{}, {'precision': 'compact'}]:
+            t = Table()
+            t.readStar(StringIO(text), **kwargs)
+            self.assertEqual(['007', '1e3', '2'],
+                             t.getColumnValues('label')[:3])
+
+        # Columns with a given type are not promoted
+        with self.assertRaises(ParseError):
+            Table().readStar(StringIO(starStr), types={'x': int})
+
+        # Without raising errors, wrong numbers are errors and not str
+        stats = Stats()
+        t = Table()
+        t.readStar(StringIO(starStr), errors='collect', stats=stats)
+        self.assertEqual([int, float, int],
+                         [c.getType() for c in t.getColumns()])
+        self.assertEqual(152, len(t))
+        self.assertEqual([157], [e.lineNo for e in t.getErrors()])
+        self.assertEqual(1, stats.promotions)
+
+        # The types are guessed from the first rows, before reading
+        reader = Table.Reader(StringIO(starStr))
+        self.assertEqual([int, int, int],
+                         [c.getType() for c in reader.getColumns()])
+        lines[6] = '1 1.0 A'
+        reader = Table.Reader(StringIO('\n'.join(lines)))
+        self.assertEqual([int, float, str],
+                         [c.getType() for c in reader.getColumns()])
+        self.assertEqual((0, 0.0, '0'), tuple(reader.getRow()))
+
+        # Rows read ahead by chunks are converted again when promoted
+        starStr = 'data_\nloop_\n_x\n%s\n' % '\n'.join(
+            '%d.5' % i if i == 250 else str(i) for i in range(300))
+        for chunkSize in [50, 100, 250]:
+            reader = Table.Reader(StringIO(starStr))
+            chunk = reader.readChunk(chunkSize)
+            while chunk is not None:
+                self.assertEqual(1, len(set(map(type, chunk[0]))))
+                chunk = reader.readChunk(chunkSize)
+            self.assertEqual(float, reader.getColumn('x').getType())
+
+    def test_sortKeys(self):
+        print("Checking sort with many keys...")
+        dataFile = testfile('star', 'refine3d', 'run_it016_data.star')
+        table = Table(fileName=dataFile, tableName='particles')
+        rows = list(table)
+
+        def _key(r):
+            return r.rlnMicrographName, -r.rlnDefocusU
+
+        keys = ['rlnMicrographName', 'rlnDefocusU']
+        order = table.argsort(keys, reverse=[False, True])
+        self.assertEqual(rows, list(table))  # argsort does not modify it
+        self.assertEqual(sorted(rows, key=_key), [rows[i] for i in order])
+
+        table.sort(keys, reverse=[False, True])
+        self.assertEqual(sorted(rows, key=_key), list(table))
+
+        # A single key, reverse order and a key function
+        table.sort('rlnDefocusU', reverse=True)
+        self.assertEqual(sorted(rows, key=lambda r: r.rlnDefocusU,
+                                reverse=True), list(table))
+        table.sort(lambda r: r.rlnImageName)
+        self.assertEqual(sorted(rows, key=lambda r: r.rlnImageName),
+                         list(table))
+
+        with self.assertRaises(Exception):
+            table.sort(keys, reverse=[True])
+        with self.assertRaises(Exception):
+            table.argsort('rlnWrongColumn')
+
+        # Values that are not of the column type are not truncated
+        for values in [[2, 1.7, 1, 1.2], [2 ** 70, 1, -5, 2 ** 64]]:
+            t = Table.fromColumns({'a': values, 'b': ['x'] * len(values)})
+            self.assertEqual(int, t.getColumn('a').getType())
+            for reverse in [False, True]:
+                t.sort(['a', 'b'], reverse=reverse)
+                self.assertEqual(sorted(values, reverse=reverse),
+                                 t.getColumnValues('a'))
+
+    def test_views(self):
+        print("Checking views...")
+        dataFile = testfile('star', 'refine3d', 'run_it016_data.star')
+        table = Table(fileName=dataFile, tableName='particles')
+        rows = list(table)
+        n = len(rows)
+
+        self.assertEqual(rows[2], table[2])
+        self.assertEqual(rows[-1], table[-1])
+        self.assertEqual(rows[2:10], list(table[2:10]))
+        self.assertEqual(rows[::-3], list(table[::-3]))
+        self.assertEqual([rows[5], rows[0]], list(table[[5, 0]]))
+        self.assertEqual(table.getColumnNames(),
+                         table[:3].getColumnNames())
+
+        defocus = table.getColumnArray('rlnDefocusU')
+        mask = defocus > defocus.mean()
+        selected = [r for r in rows if r.rlnDefocusU > defocus.mean()]
+        self.assertEqual(selected, list(table[mask]))
+        self.assertEqual(selected, list(table[mask.tolist()]))
+        self.assertEqual(selected, list(table.select(
+            lambda r: r.rlnDefocusU > defocus.mean())))
+
+        # Views of views and their columns
+        view = table[mask][1::2][[0, -1]]
+        self.assertEqual([selected[1], selected[1::2][-1]], list(view))
+        self.assertEqual([r.rlnImageName for r in view],
+                         view.getColumnValues('rlnImageName'))
+        self.assertEqual(selected[1::2][-1].rlnDefocusU,
+                         view.getColumnArray('rlnDefocusU')[1])
+
+        # Views are copied when modified, the parent is not changed
+        view.removeColumns('rlnImageName')
+        view.addRow(*view[0])
+        self.assertEqual(3, len(view))
+        self.assertEqual(rows, list(table))
+        self.assertIn('rlnImageName', table.getColumnNames())
+
+        # Views are not changed when the parent is modified
+        view = table[:3]
+        table.sort('rlnDefocusU', reverse=True)
+        table[0] = rows[5]
+        table.addRow(*rows[6])
+        self.assertEqual(rows[:3], list(view))
+        self.assertEqual(rows[5], table[0])
+        table.read(dataFile, 'particles')
+
+        # Write a view and views of compact (frozen) tables
+        with tempfile.TemporaryDirectory() as tmpDir:
+            outFile = os.path.join(tmpDir, 'view.star')
+            table[mask].write(outFile, 'particles')
+            self.assertEqual(selected, list(Table(fileName=outFile)))
+
+        compact = Table()
+        compact.read(dataFile, 'particles', precision='compact')
+        view = compact[10:20]
+        self.assertEqual(list(compact)[10:20], list(view))
+        self.assertTrue(np.array_equal(
+            compact.getColumnArray('rlnDefocusU')[10:20],
+            view.getColumnArray('rlnDefocusU')))
+        view.sort('rlnDefocusU')
+        self.assertTrue(compact.isFrozen())
+
+        # Empty slices of views, also reversed ones before the first row
+        for item in [slice(-2 * n, None, -1), slice(5, 5), slice(3, 1)]:
+            expected = rows[item]
+            self.assertEqual(expected, list(table[:][item]))
+            self.assertEqual(len(expected), len(compact[item]))
+            self.assertEqual(len(expected),
+                             len(compact[item].getColumnArray('rlnDefocusU')))
+            self.assertEqual(len(expected),
+                             len(compact[:][item].getColumnArray('rlnDefocusU')))
+
+        with self.assertRaises(Exception):
+            table[[True, False]]
+        with self.assertRaises(IndexError):
+            table[[0, n]]
+
+
+def _sumColumn(sharedTable, colName):
+    """ Function used by test_freeze in worker processes. """
+    if colName == 'rlnImageName':
+        return len(set(sharedTable.getColumnValues(colName)))
+    return sum(getattr(r, colName) for r in sharedTable.getTable())
+
+
+def _getSharedTable(sharedTable):
+    """ Function used by test_freeze in worker processes. """
+    table = sharedTable.getTable()
+    return [tuple(r) for r in table]
+
 
 N = 100
 